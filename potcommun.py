@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 import warnings
+import weakref
+import heapq
+import bisect
+import time
 import re
+from contextlib import contextmanager
 
 __version__ = "1.0"
 
+AMOUNT_RE = re.compile(ur"^ *(\d{1,9})(?:[,.](\d{1,2}))?(?: *€? *)?$")
+
+
 def getAmountAsString(amount):
     if amount < 0:
         return u"%d,%02d €" % ((amount + 99) // 100, -amount % 100)
@@ -12,23 +20,217 @@ def getAmountAsString(amount):
         return u"%d,%02d €" % (amount // 100, amount % 100)
 
 
-def getAmountAsInt(amountAsString):
-    RE = ur"^ *(\d{1,9})(?:[,.](\d{1,2}))?(?: *€? *)?$"
+def getAmountsAsString(amounts):
+    """
+        Return the list of the amounts formatted by getAmountAsString.
+        amounts may be any sequence of cents, a NumPy array included.
+    """
+    if hasattr(amounts, "tolist"):
+        amounts = amounts.tolist()
+    return [u"%d,%02d €" % ((amount + 99) // 100, -amount % 100) if amount < 0 else u"%d,%02d €" % (amount // 100, amount % 100)
+        for amount in amounts]
 
-    if len(amountAsString) > 0:
-        result = re.findall(RE, amountAsString)
-        euros = result[0][0]
-        cents = result[0][1]
-        if len(cents) == 0:
-            cents = 0
 
-        amount = int(euros) * 100 + int(cents)
+def isPlainNumber(text):
+    """
+        True for 1 to 9 ASCII digits.
+    """
+    return len(text) <= 9 and text.isdigit() and max(text) <= "9"
+
+
+def getAmountAsInt(amountAsString):
+    if len(amountAsString) > 0:
+        if isPlainNumber(amountAsString):
+            return int(amountAsString) * 100
+        match = AMOUNT_RE.match(amountAsString)
+        if match is None:
+            raise IndexError("Wrong amount: %r" % amountAsString)
+        euros, cents = match.groups()
+        amount = int(euros) * 100 + int(cents or 0)
     else:
         amount = 0
 
     return amount
 
 
+def getAmountsAsInt(amountsAsStrings):
+    """
+        Parse a sequence of amounts like getAmountAsInt, and return the
+        amounts and an errors mask: the amount of a wrong element is 0, and
+        its mask value is True. Integers are taken as cents.
+
+        A NumPy array gives NumPy arrays back.
+    """
+    if hasattr(amountsAsStrings, "dtype"):
+        import numpy
+        if amountsAsStrings.dtype.kind in "iu":
+            return amountsAsStrings.astype(numpy.int64), numpy.zeros(len(amountsAsStrings), dtype=bool)
+        amounts, errors = getAmountsAsInt(amountsAsStrings.tolist())
+        return numpy.array(amounts, dtype=numpy.int64), numpy.array(errors, dtype=bool)
+
+    amounts = []
+    errors = []
+    match = AMOUNT_RE.match
+    for text in amountsAsStrings:
+        if isinstance(text, basestring):
+            if len(text) == 0:
+                amounts.append(0)
+                errors.append(False)
+                continue
+            if isPlainNumber(text):
+                amounts.append(int(text) * 100)
+                errors.append(False)
+                continue
+            result = match(text)
+            if result is not None:
+                euros, cents = result.groups()
+                amounts.append(int(euros) * 100 + int(cents or 0))
+                errors.append(False)
+                continue
+        elif isinstance(text, (int, long)) and not isinstance(text, bool):
+            amounts.append(text)
+            errors.append(False)
+            continue
+        amounts.append(0)
+        errors.append(True)
+    return amounts, errors
+
+
+class ObservedSet(set):
+    """
+        A set telling its owner about every element added or removed.
+
+        The owner must provide elementsChanging(observedSet), called before
+        the set changes, elementsAdded(observedSet, elements) and
+        elementsRemoved(observedSet, elements).
+    """
+    __slots__ = ("owner",)
+
+    def __init__(self, iterable=(), owner=None):
+        set.__init__(self, iterable)
+        self.owner = owner
+
+    def notifyChanging(self):
+        if self.owner is not None:
+            self.owner.elementsChanging(self)
+
+    def notifyAdded(self, elements):
+        if len(elements) > 0 and self.owner is not None:
+            self.owner.elementsAdded(self, elements)
+
+    def notifyRemoved(self, elements):
+        if len(elements) > 0 and self.owner is not None:
+            self.owner.elementsRemoved(self, elements)
+
+    def add(self, element):
+        if element not in self:
+            self.notifyChanging()
+            set.add(self, element)
+            self.notifyAdded((element,))
+
+    def discard(self, element):
+        if element in self:
+            self.notifyChanging()
+            set.discard(self, element)
+            self.notifyRemoved((element,))
+
+    def remove(self, element):
+        if element in self:
+            self.notifyChanging()
+        set.remove(self, element)
+        self.notifyRemoved((element,))
+
+    def pop(self):
+        if len(self) > 0:
+            self.notifyChanging()
+        element = set.pop(self)
+        self.notifyRemoved((element,))
+        return element
+
+    def clear(self):
+        if len(self) > 0:
+            self.notifyChanging()
+        removed = list(self)
+        set.clear(self)
+        self.notifyRemoved(removed)
+
+    def update(self, *others):
+        added = []
+        for other in others:
+            for element in other:
+                if element not in self:
+                    if len(added) == 0:
+                        self.notifyChanging()
+                    set.add(self, element)
+                    added.append(element)
+        self.notifyAdded(added)
+
+    def difference_update(self, *others):
+        removed = []
+        for other in others:
+            for element in other:
+                if element in self:
+                    if len(removed) == 0:
+                        self.notifyChanging()
+                    set.discard(self, element)
+                    removed.append(element)
+        self.notifyRemoved(removed)
+
+    def intersection_update(self, *others):
+        self.notifyChanging()
+        before = set(self)
+        set.intersection_update(self, *others)
+        self.notifyRemoved(list(before - self))
+
+    def symmetric_difference_update(self, other):
+        self.notifyChanging()
+        before = set(self)
+        set.symmetric_difference_update(self, other)
+        self.notifyRemoved(list(before - self))
+        self.notifyAdded(list(self - before))
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def __reduce__(self):
+        # Elements and owner as the state: they may refer back to this set
+        return (type(self), (), (list(self), self.owner))
+
+    def __setstate__(self, state):
+        elements, self.owner = state
+        set.update(self, elements)
+
+
+def getSlotsState(instance, ignored=()):
+    """
+        Return {slot: value} for the slots set on instance, for __getstate__.
+    """
+    state = {}
+    for cls in type(instance).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if name != "__weakref__" and name not in ignored and hasattr(instance, name):
+                state[name] = getattr(instance, name)
+    return state
+
+
+def setSlotsState(instance, state):
+    for name, value in state.items():
+        setattr(instance, name, value)
+
+
 class DebtManager(object):
     """
         A debt manager, core of this module.
@@ -93,10 +295,194 @@ class DebtManager(object):
 
     """
 
-    def __init__(self, name="unnamed"):
+    def __init__(self, name="unnamed", incremental=True):
+        """
+            With incremental set, per-person totals are kept up to date as
+            transactions are added, removed or edited, so computeTotals only
+            recomputes what changed since the last call.
+        """
         self.name = name
+        self.incremental = incremental
+        self.listeners = set()
+        self.balanceObservers = []
+        self.personsRegistry = PersonsRegistry()
+        # Balances last told to the observers, and persons ids whose balance may have changed since
+        self._notifiedBalances = None
+        self._balancesTouched = None
+        self.resetLedger()
         self.transactions = set()
 
+    # See enableProfiling
+    profiler = None
+
+    # The running edit session, see edit
+    session = None
+
+    @contextmanager
+    def edit(self):
+        """
+            Edit transactions in a session:
+            >>> with mgr.edit():
+            ...     outlay.items.add(item)
+            ...     mgr.transactions.add(refund)
+
+            Listeners are told of the changes only at the end of the session,
+            once per changed transaction, the totals are recomputed once, and
+            balance observers are called once.
+            Before that, the changed transactions are validated (see
+            Transaction.validate): if one is wrong, or if an exception is
+            raised in the session, all the changes are rolled back and the
+            exception is raised again. Only the changed transactions are
+            saved for the rollback, before their first change.
+        """
+        if self.session is not None:
+            raise RuntimeError("An edit session is already running")
+        session = self.session = EditSession(self)
+        try:
+            yield session
+            session.validate()
+        except:
+            try:
+                session.rollback()
+            finally:
+                del self.session
+            self.notifyBalances()
+            raise
+        del self.session
+        session.commit()
+
+    def enableProfiling(self, profiler=None):
+        """
+            Record the computation phases in a Profiler, and return it.
+
+            The phases methods are wrapped on this instance only: when
+            profiling is disabled, they are called without any overhead.
+        """
+        if self.profiler is not None:
+            self.disableProfiling()
+        if profiler is None:
+            profiler = Profiler()
+        for phase in Profiler.PHASES:
+            setattr(self, phase, profiler.wrap(phase, getattr(self, phase)))
+        self.profiler = profiler
+        return profiler
+
+    def disableProfiling(self):
+        """
+            Stop profiling, and return the profiler (None if not profiling).
+        """
+        profiler = self.profiler
+        if profiler is not None:
+            for phase in Profiler.PHASES:
+                delattr(self, phase)
+            del self.profiler
+        return profiler
+
+    def getProfilingStats(self):
+        return {} if self.profiler is None else self.profiler.getStats()
+
+    @contextmanager
+    def profile(self):
+        """
+            Profile the calls done in a with block, in a new Profiler:
+            >>> with mgr.profile() as profiler:
+            ...     mgr.getReport()
+            >>> profiler.getStats()["iterPersonReport"]["time"]
+        """
+        previous = self.disableProfiling()
+        profiler = self.enableProfiling()
+        try:
+            yield profiler
+        finally:
+            self.disableProfiling()
+            if previous is not None:
+                self.enableProfiling(previous)
+
+    def profileReport(self, executor=None):
+        """
+            Return the report and the profiling stats of its computation.
+        """
+        with self.profile() as profiler:
+            report = self.getReport(executor)
+        return report, profiler.getStats()
+
+    def getTransactions(self):
+        return self._transactions
+
+    def setTransactions(self, transactions):
+        old = getattr(self, "_transactions", ())
+        if transactions is old:
+            return
+        self.elementsChanging(old)
+        self.elementsRemoved(old, old)
+        self._transactions = ObservedSet(transactions, self)
+        self.elementsAdded(self._transactions, self._transactions)
+        self.resetLedger()
+        self.notifyBalances()
+
+    transactions = property(getTransactions, setTransactions)
+
+    def elementsChanging(self, transactions):
+        if self.session is not None:
+            self.session.saveTransactions()
+
+    def elementsAdded(self, transactions, added):
+        for transaction in added:
+            transaction.listeners.add(self)
+            self.markChanged(transaction)
+        self.notifyBalances()
+
+    def elementsRemoved(self, transactions, removed):
+        for transaction in removed:
+            if self.session is not None:
+                # No longer listened to: saved as it is now
+                self.session.saveState(transaction)
+            transaction.listeners.discard(self)
+            self.markChanged(transaction)
+        self.notifyBalances()
+
+    def transactionChanging(self, transaction):
+        """
+            Called before a transaction is modified.
+        """
+        if self.session is not None:
+            self.session.saveState(transaction)
+
+    def transactionChanged(self, transaction):
+        """
+            Called when a transaction is added, removed or modified. Listeners
+            (like save handlers) are told in turn, then balance observers.
+        """
+        self.markChanged(transaction)
+        self.notifyBalances()
+
+    def markChanged(self, transaction):
+        self._dirty.add(transaction)
+        self._index = None
+        self._dateIndex = None
+        if self.session is not None:
+            # Listeners are told when the session is committed
+            self.session.touched.add(transaction)
+            return
+        for listener in list(self.listeners):
+            listener.transactionChanged(transaction)
+
+    def resetLedger(self):
+        """
+            Forget the running totals: they will be rebuilt on next use.
+        """
+        # Indexed by person id (see PersonsRegistry); persons count is the number of transactions of each
+        personsCount = len(self.personsRegistry)
+        self._itemsTotals = [0] * personsCount
+        self._paymentTotals = [0] * personsCount
+        self._personsCount = [0] * personsCount
+        self._contributions = {}
+        self._dirty = set(getattr(self, "_transactions", ()))
+        self._index = None
+        self._dateIndex = None
+        if self._balancesTouched is not None:
+            self._balancesTouched.update(self._notifiedBalances)
+
     def getPersons(self):
         result = set()
         for transaction in self.transactions:
@@ -132,7 +518,6 @@ class DebtManager(object):
         """
         itemsTotal = sum(items.values())
         paymentsTotal = sum(payments.values())
-        roundingError = 0
 
         # We only adjust the items : what has been paid should't be adjusted
         # It only change the way the computation is done, but the result is the same
@@ -146,30 +531,134 @@ class DebtManager(object):
         else:
             elemToAdjust = None
 
-        if elemToAdjust is not None:
-            missingPerPerson = missingAmount // len(persons)
-            divisor = len(persons)
-            roundingError = missingAmount - missingAmount // divisor * divisor
-
         for person in persons:
             for elem in [items, payments]:
-                if person not in elem.keys():
+                if person not in elem:
                     elem[person] = 0
 
         if elemToAdjust is None:
             return items, payments
 
-        for person in persons:
-            elemToAdjust[person] += missingPerPerson
-
-        while roundingError > 0:
-            for person in persons:
-                elemToAdjust[person] += 1 if roundingError > 0 else 0 
-                roundingError -= 1
+        # Equal shares, the cents left going to the first persons by name
+        for person, amount in apportion(missingAmount, [(person, 1) for person in sortedPersons(persons)]).items():
+            elemToAdjust[person] += amount
 
         return items, payments
 
+    def computeTransactionTotals(self, transaction):
+        """
+            Return the adjusted items and payments totals of one transaction,
+            adjusted by self.checkAndAdjustTotals unless memoized.
+        """
+        return transaction.getTotals(self.checkAndAdjustTotals)
+
+    def computeContribution(self, transaction):
+        """
+            Return the totals of a transaction as [(person id, items total, payments total)].
+        """
+        itemsTotals, paymentsTotals = self.computeTransactionTotals(transaction)
+        getId = self.personsRegistry.getId
+        contribution = [(getId(person), amount, paymentsTotals[person]) for person, amount in itemsTotals.items()]
+        missing = len(self.personsRegistry) - len(self._itemsTotals)
+        if missing > 0:
+            self._itemsTotals.extend([0] * missing)
+            self._paymentTotals.extend([0] * missing)
+            self._personsCount.extend([0] * missing)
+        return contribution
+
+    def applyContribution(self, contribution, sign):
+        itemsTotals = self._itemsTotals
+        paymentTotals = self._paymentTotals
+        personsCount = self._personsCount
+        for personId, itemsAmount, paymentsAmount in contribution:
+            itemsTotals[personId] += sign * itemsAmount
+            paymentTotals[personId] += sign * paymentsAmount
+            personsCount[personId] += sign
+        if self._balancesTouched is not None:
+            self._balancesTouched.update(personId for personId, itemsAmount, paymentsAmount in contribution)
+
+    def updateLedger(self):
+        """
+            Fold the transactions changed since the last call into the running totals.
+        """
+        for transaction in list(self._dirty):
+            contribution = None
+            if transaction in self._transactions:
+                contribution = self.computeContribution(transaction)
+            if transaction in self._contributions:
+                self.applyContribution(self._contributions.pop(transaction), -1)
+            if contribution is not None:
+                self.applyContribution(contribution, 1)
+                self._contributions[transaction] = contribution
+            self._dirty.discard(transaction)
+
+    def subscribeBalances(self, observer):
+        """
+            Call observer({person: new balance}) with the persons whose balance
+            changed, after each change of the transactions (a Refund.update,
+            or the changes in a Transaction.batch, being one change), or once
+            for all the transactions added or removed together, or for an
+            edit session.
+
+            Only the changed transactions are computed again (with the running
+            totals of the incremental mode, which is required). A person no
+            longer in the pot has a balance of 0.
+        """
+        if not self.incremental:
+            raise ValueError("Balance observers need an incremental debt manager")
+        if self._balancesTouched is None:
+            self.updateLedger()
+            self._notifiedBalances = dict((personId, self._itemsTotals[personId] - self._paymentTotals[personId])
+                for personId in self.getLedgerIds())
+            self._balancesTouched = set()
+        self.balanceObservers.append(observer)
+
+    def unsubscribeBalances(self, observer):
+        self.balanceObservers.remove(observer)
+        if len(self.balanceObservers) == 0:
+            self._notifiedBalances = None
+            self._balancesTouched = None
+
+    def notifyBalances(self):
+        """
+            Tell the balance observers about the changes done since the last call.
+        """
+        if self._balancesTouched is None or self.session is not None:
+            return
+        self.updateLedger()
+        changes = {}
+        persons = self.personsRegistry.persons
+        for personId in self._balancesTouched:
+            present = personId < len(self._personsCount) and self._personsCount[personId] > 0
+            balance = self._itemsTotals[personId] - self._paymentTotals[personId] if present else 0
+            if balance != self._notifiedBalances.get(personId, 0):
+                changes[persons[personId]] = balance
+            if present:
+                self._notifiedBalances[personId] = balance
+            else:
+                self._notifiedBalances.pop(personId, None)
+        self._balancesTouched.clear()
+        if len(changes) > 0:
+            for observer in list(self.balanceObservers):
+                observer(changes)
+
+    def getLedgerIds(self):
+        """
+            Return the ids of the persons of the running totals.
+        """
+        personsCount = self._personsCount
+        return [personId for personId in xrange(len(personsCount)) if personsCount[personId] > 0]
+
     def computeTotals(self):
+        if not self.incremental:
+            return self.computeTotalsFromScratch()
+        self.updateLedger()
+        persons = self.personsRegistry.persons
+        ids = self.getLedgerIds()
+        return (dict((persons[personId], self._itemsTotals[personId]) for personId in ids),
+            dict((persons[personId], self._paymentTotals[personId]) for personId in ids))
+
+    def computeTotalsFromScratch(self):
         itemsTotals = {}
         paymentTotals = {}
         for transaction in self.transactions:
@@ -181,14 +670,28 @@ class DebtManager(object):
 
         return itemsTotals, paymentTotals
 
-    def computeBalances(self):
+    def computeBalances(self, asOf=None):
+        """
+            Return {person: balance}. With asOf (a datetime), only the
+            transactions up to this date are taken into account (see
+            computeBalancesAsOf).
+        """
+        if asOf is not None:
+            return self.computeBalancesAsOf(asOf)
+        if self.incremental:
+            self.updateLedger()
+            persons = self.personsRegistry.persons
+            itemsTotals = self._itemsTotals
+            paymentTotals = self._paymentTotals
+            return dict((persons[personId], itemsTotals[personId] - paymentTotals[personId]) for personId in self.getLedgerIds())
         totals = self.computeTotals()
         result = {}
         for name in totals[0].keys():
             result[name] = totals[0][name] - totals[1][name]
         return result
 
-    def filterNull(self, balances):
+    @staticmethod
+    def filterNull(balances):
         names = []
         for name, amount in balances.items():
             if amount == 0:
@@ -197,12 +700,67 @@ class DebtManager(object):
             del balances[name]
         return balances
 
-    def computeDebts(self):
-        balances = self.computeBalances()
+    def computeDebts(self, asOf=None):
+        return self.settleBalances(self.computeBalances(asOf))
+
+    @staticmethod
+    def settleBalances(balances):
+        """
+            Return the (debtor, amount, creditor) tuples settling the balances.
+
+            The biggest debtor always pays the biggest creditor. Creditors and
+            debtors are kept in two heaps, so that settling n persons is
+            O(n log n). Ties are broken on the balances dict order, which gives
+            the very same debts as settleBalancesBySorting.
+        """
+        creditors = []
+        debtors = []
+        for index, (name, amount) in enumerate(balances.items()):
+            if amount < 0:
+                creditors.append((amount, index, name))
+            elif amount > 0:
+                debtors.append((-amount, -index, name))
+        heapq.heapify(creditors)
+        heapq.heapify(debtors)
+
         debts = []
-        balances = self.filterNull(balances)
-        while len(balances) > 1:
-            names = balances.keys()
+        while len(creditors) > 0 and len(debtors) > 0:
+            pa, creditorIndex, creditor = heapq.heappop(creditors)
+            pb, debtorIndex, debtor = heapq.heappop(debtors)
+            pb = -pb
+            ## debtor owes creditor
+            if -pa >= pb:
+                debts.append((debtor, pb, creditor))
+                if pa + pb != 0:
+                    heapq.heappush(creditors, (pa + pb, creditorIndex, creditor))
+            else:
+                debts.append((debtor, -pa, creditor))
+                heapq.heappush(debtors, (-(pb + pa), debtorIndex, debtor))
+
+        if len(creditors) > 0 or len(debtors) > 0:
+            raise RuntimeError("Wrong balances!")
+        return tuple(debts)
+
+    def computeMinimalDebts(self, maxTime=0.1, maxNodes=None, asOf=None):
+        """
+            Like computeDebts, but try to reduce the number of transfers.
+
+            See SettlementOptimizer: the search stops after maxTime seconds or
+            maxNodes steps, and the result is never worse than computeDebts.
+        """
+        return SettlementOptimizer(maxTime, maxNodes).settle(self.computeBalances(asOf))
+
+    @classmethod
+    def settleBalancesBySorting(cls, balances):
+        """
+            Reference implementation of settleBalances, sorting all the
+            balances again after each debt: O(n² log n).
+        """
+        order = [name for name, amount in balances.items() if amount != 0]
+        balances = dict(balances)
+        debts = []
+        while len(order) > 1:
+            names = list(order)
             names.sort(cmp=lambda x, y: cmp(balances[x], balances[y]))
             pa = balances[names[0]]
             pb = balances[names[-1]]
@@ -216,12 +774,81 @@ class DebtManager(object):
                 balances[names[0]] = 0
                 balances[names[-1]] += pa
 
-            balances = self.filterNull(balances)
+            order = [name for name in order if balances[name] != 0]
 
-        if len(balances) > 0:
+        if len(order) > 0:
             raise RuntimeError("Wrong balances!")
         return tuple(debts)
 
+    # Balances are kept before every CHECKPOINT_EVERY transactions of the date index
+    CHECKPOINT_EVERY = 64
+
+    @staticmethod
+    def getDateKey(date):
+        """
+            Key sorting the dates, transactions without date first.
+        """
+        return (0, None) if date is None else (1, date)
+
+    def getDateIndex(self):
+        """
+            Return the date index (see computeDateIndex), computed once
+            until a transaction changes.
+        """
+        if not self.incremental:
+            return self.computeDateIndex()
+        if self._dateIndex is None:
+            self._dateIndex = self.computeDateIndex()
+        return self._dateIndex
+
+    def computeDateIndex(self):
+        """
+            Return (keys, transactions, deltas, checkpoints): the transactions
+            sorted by date, their date keys, their {person: balance change},
+            and the balances before the transactions 0, CHECKPOINT_EVERY,
+            2 * CHECKPOINT_EVERY... and after the last one.
+        """
+        transactions = sorted(self.transactions, key=lambda transaction: self.getDateKey(transaction.date))
+        keys = [self.getDateKey(transaction.date) for transaction in transactions]
+        deltas = []
+        checkpoints = []
+        balances = {}
+        for position, transaction in enumerate(transactions):
+            if position % self.CHECKPOINT_EVERY == 0:
+                checkpoints.append(dict(balances))
+            itemsTotals, paymentsTotals = self.computeTransactionTotals(transaction)
+            delta = dict((person, amount - paymentsTotals[person]) for person, amount in itemsTotals.items())
+            deltas.append(delta)
+            Item.mergeTotals(balances, delta)
+        if len(transactions) % self.CHECKPOINT_EVERY == 0:
+            checkpoints.append(balances)
+        return keys, transactions, deltas, checkpoints
+
+    def computeBalancesAsOf(self, asOf):
+        """
+            Return the balances after the transactions dated up to asOf
+            (included) and the transactions without date: a binary search,
+            then at most CHECKPOINT_EVERY transactions added to a checkpoint.
+        """
+        keys, transactions, deltas, checkpoints = self.getDateIndex()
+        stop = bisect.bisect_right(keys, self.getDateKey(asOf))
+        checkpoint = stop // self.CHECKPOINT_EVERY
+        balances = dict(checkpoints[checkpoint])
+        for delta in deltas[checkpoint * self.CHECKPOINT_EVERY:stop]:
+            Item.mergeTotals(balances, delta)
+        return balances
+
+    def getTransactionsBetween(self, start=None, stop=None):
+        """
+            Return the transactions dated from start (included) to stop
+            (excluded), sorted by date. Transactions without date are
+            returned only when start is None.
+        """
+        keys, transactions = self.getDateIndex()[:2]
+        first = 0 if start is None else bisect.bisect_left(keys, self.getDateKey(start))
+        last = len(keys) if stop is None else bisect.bisect_left(keys, self.getDateKey(stop))
+        return transactions[first:last]
+
     def getItemsPerPerson(self):
         return self.getPaymentsOrItemsOrRefundsPerPerson()
 
@@ -232,111 +859,158 @@ class DebtManager(object):
         return self.getPaymentsOrItemsOrRefundsPerPerson(isRefund=True)
 
     def getPaymentsOrItemsOrRefundsPerPerson(self, isPayment=False, isRefund=False):
-        result = {}
-        for person in self.getPersons():
-            resultForPerson = {}
-            for transaction in self.transactions:
-                persons_for_transaction = transaction.getPersons()
-                if person not in persons_for_transaction:
-                    continue
-
-                if isRefund and isinstance(transaction, Refund):
+        """
+            The returned dicts are shared with the index and must not be modified.
+        """
+        items, payments, refunds = self.getPerPersonIndex()
+        if isRefund:
+            return refunds
+        return payments if isPayment else items
+
+    def getPerPersonIndex(self):
+        """
+            Return the (items, payments, refunds) per person, computed once
+            until a transaction changes (see computePerPersonIndex).
+        """
+        if self._index is None:
+            self._index = self.computePerPersonIndex()
+        return self._index
+
+    def computePerPersonIndex(self):
+        """
+            Walk the transactions once, and return the items, payments and
+            refunds per person, as {person: {(date, label, total): elems}}.
+        """
+        allItems = {}
+        allPayments = {}
+        allRefunds = {}
+        for transaction in self.transactions:
+            persons = transaction.getPersons()
+            if len(persons) == 0:
+                continue
+
+            if isinstance(transaction, Refund):
+                for person in persons:
                     if person == transaction.debitPerson:
                         label = u"Remboursement à %s" % transaction.creditPerson.name
                         amount = -transaction.amount
                     else:
                         label = u"Remboursement de %s" % transaction.debitPerson.name
                         amount = transaction.amount
-                    resultForPerson[(transaction.date, label, amount)] = (set(transaction.items).pop(), set(transaction.payments).pop())
-                elif not isRefund and isinstance(transaction, Outlay):
-                    items = set()
-
-                    amount = 0
-
-                    elems = transaction.payments if isPayment else transaction.items
-                    for elem in elems:
-                        amounts = elem.computeAmountPerPerson()
-                        try:
-                            if isPayment:
-                                items.add(amounts[person])
-                            else:
-                                if len(elem.persons) > 1:
-                                    items.add((u"1/%d %s" % (len(elem.persons), elem.label), amounts[person]))
-                                else:
-                                    items.add((elem.label, amounts[person]))
-                            amount += amounts[person]
-                        except KeyError:
-                            pass
-
-                    perTransactionItemsTotals = AbstractPayment.computeTotals(transaction.items)
-                    perTransactionPaymentsTotals = AbstractPayment.computeTotals(transaction.payments)
-                    perTransactionItemsTotals, perTransactionPaymentsTotals = self.checkAndAdjustTotals(persons_for_transaction, perTransactionItemsTotals, perTransactionPaymentsTotals)
-
-                    if isPayment:
-                        if amount != perTransactionPaymentsTotals[person]:
-                            raise ValueError("Adjustements on payments are forbidden")
-                    else:
-                        if amount < perTransactionItemsTotals[person]:
-                            items.add((u"(1/%d)" % len(persons_for_transaction), perTransactionItemsTotals[person] - amount))
-                        elif amount > perTransactionItemsTotals[person]:
-                            items.add((u"(Réduction)", perTransactionItemsTotals[person] - amount))
-
-                    total = sum(perTransactionItemsTotals.values())
-                    total2 = sum(perTransactionPaymentsTotals.values())
-                    assert total == total2
-                    if len(items) > 0:
-                        resultForPerson[(transaction.date, transaction.label, total)] = items
-            if len(resultForPerson.keys()) > 0:
-                result[person] = resultForPerson
-        return result
+                    allRefunds.setdefault(person, {})[(transaction.date, label, amount)] = (set(transaction.items).pop(), set(transaction.payments).pop())
+            elif isinstance(transaction, Outlay):
+                self.indexOutlay(transaction, persons, allItems, allPayments)
+
+        return allItems, allPayments, allRefunds
+
+    def indexOutlay(self, transaction, persons, allItems, allPayments):
+        itemsPerPerson = {}
+        itemsAmounts = {}
+        for item, amounts in transaction.getItemsAmountsPerPerson().items():
+            for person, amount in amounts.items():
+                share = item.getShareLabel(person)
+                if share is not None:
+                    elem = (share + u" " + item.label, amount)
+                else:
+                    elem = (item.label, amount)
+                itemsPerPerson.setdefault(person, set()).add(elem)
+                itemsAmounts[person] = itemsAmounts.get(person, 0) + amount
+
+        paymentsPerPerson = {}
+        paymentsAmounts = {}
+        for amounts in transaction.getPaymentsAmountsPerPerson().values():
+            for person, amount in amounts.items():
+                paymentsPerPerson.setdefault(person, set()).add(amount)
+                paymentsAmounts[person] = paymentsAmounts.get(person, 0) + amount
+
+        itemsTotals, paymentsTotals = self.computeTransactionTotals(transaction)
+        total = sum(itemsTotals.values())
+        assert total == sum(paymentsTotals.values())
+        key = (transaction.date, transaction.label, total)
+
+        for person in persons:
+            if paymentsAmounts.get(person, 0) != paymentsTotals[person]:
+                raise ValueError("Adjustements on payments are forbidden")
+            if person in paymentsPerPerson:
+                allPayments.setdefault(person, {})[key] = paymentsPerPerson[person]
+
+            items = itemsPerPerson.get(person, set())
+            amount = itemsAmounts.get(person, 0)
+            if amount < itemsTotals[person]:
+                items.add((u"(1/%d)" % len(persons), itemsTotals[person] - amount))
+            elif amount > itemsTotals[person]:
+                items.add((u"(Réduction)", itemsTotals[person] - amount))
+            if len(items) > 0:
+                allItems.setdefault(person, {})[key] = items
+
+
+    @staticmethod
+    def getItemsTotal(items):
+        return sum(item[1] for elems in items.values() for item in elems)
 
+    @staticmethod
+    def getPaymentsTotal(payments):
+        return sum(sum(elems) for elems in payments.values())
+
+    @staticmethod
+    def getRefundsTotal(refunds):
+        return sum(dl[2] for dl in refunds.keys())
 
     def getReportItems(self, items):
-        text = u"\n --- Dépenses ---\n\n"
+        return self.getItemsTotal(items), u"".join(self.iterReportItems(items))
+
+    @classmethod
+    def iterReportItems(cls, items):
+        yield u"\n --- Dépenses ---\n\n"
         datesAndlabels = items.keys()
         datesAndlabels.sort()
         maxLabelLen = 0
         maxAmountLen = 0
         for dl in datesAndlabels:
-            maxLabelLen = max(maxLabelLen, *map(len, [d[0] for d in items[dl]])) + 5
+            maxLabelLen = max(maxLabelLen, *map(len, [d[0] for d in items[dl]]))
             maxAmountLen = max(maxAmountLen, *map(len, [getAmountAsString(d[1]) for d in items[dl]]))
+        # Once, not per outlay: the padding grew with the number of outlays
+        maxLabelLen += 5
 
         gdTotal = 0
         for dl in datesAndlabels:
-            text += unicode(dl[0]) + u" - " + dl[1] + u"\n"
+            yield unicode(dl[0]) + u" - " + dl[1] + u"\n"
             total = 0
             for item in items[dl]:
                 amount = getAmountAsString(item[1])
                 label = item[0]
-                text += u" - " + label + u" " * (maxLabelLen - len(label)) + u" " * (maxAmountLen - len(amount)) + amount + u"\n"
+                yield u" - " + label + u" " * (maxLabelLen - len(label)) + u" " * (maxAmountLen - len(amount)) + amount + u"\n"
                 total += item[1]
             gdTotal += total
-            text += u" = Total" + u" " * (maxLabelLen - 5) + getAmountAsString(total)
-            text += u"\n\n"
+            yield u" = Total" + u" " * (maxLabelLen - 5) + getAmountAsString(total) + u"\n\n"
 
-        text += u"Total" + u" " * (maxLabelLen - 2) + getAmountAsString(gdTotal) + "\n"
-        return gdTotal, text
+        yield u"Total" + u" " * (maxLabelLen - 2) + getAmountAsString(gdTotal) + "\n"
 
     def getReportRefunds(self, refunds):
-        text = u"\n ~~~ Remboursements ~~~\n\n"
+        return self.getRefundsTotal(refunds), u"".join(self.iterReportRefunds(refunds))
+
+    @classmethod
+    def iterReportRefunds(cls, refunds):
+        yield u"\n ~~~ Remboursements ~~~\n\n"
         datesAndlabels = refunds.keys()
         datesAndlabels.sort()
         maxAmountLen = 0
         for dl in datesAndlabels:
-            maxAmountLen = max(maxAmountLen, *map(len, [getAmountAsString(dl[2]) for dl in datesAndlabels]))
+            maxAmountLen = max(maxAmountLen, len(getAmountAsString(dl[2])))
 
         gdTotal = 0
         for dl in datesAndlabels:
             amount = getAmountAsString(dl[2])
-            text += unicode(dl[0]) +  u" - " + dl[1] + u" : " + u" " * (maxAmountLen - len(amount)) + amount + "\n"
+            yield unicode(dl[0]) +  u" - " + dl[1] + u" : " + u" " * (maxAmountLen - len(amount)) + amount + "\n"
             gdTotal += dl[2]
-        text += u"\nTotal   " +  getAmountAsString(gdTotal) + "\n"
-        return gdTotal, text
-
-
+        yield u"\nTotal   " +  getAmountAsString(gdTotal) + "\n"
 
     def getReportPayments(self, payments):
-        text = u"\n +++ Paiements +++\n\n"
+        return self.getPaymentsTotal(payments), u"".join(self.iterReportPayments(payments))
+
+    @classmethod
+    def iterReportPayments(cls, payments):
+        yield u"\n +++ Paiements +++\n\n"
         datesAndlabels = payments.keys()
         datesAndlabels.sort()
         maxAmountLen = 0
@@ -352,79 +1026,657 @@ class DebtManager(object):
             padding = u" " * (maxAmountLen - len(amount))
             amounts = u", ".join([getAmountAsString(elem) for elem in p])
             total = u" = " + getAmountAsString(dl[2]) if len(payments[dl]) > 1 else u""
-            text += unicode(dl[0]) +  u" - " + dl[1] + u" : " + padding + amounts + total + "\n"
+            yield unicode(dl[0]) +  u" - " + dl[1] + u" : " + padding + amounts + total + "\n"
             gdTotal += sum(payments[dl])
-        text += u"\nTotal   " +  getAmountAsString(gdTotal) + "\n"
-        return gdTotal, text
+        yield u"\nTotal   " +  getAmountAsString(gdTotal) + "\n"
 
     def getDebtsReport(self):
-        text = u""
+        return u"".join(self.iterDebtsReport())
+
+    def iterDebtsReport(self):
         debts = self.computeDebts()
         for a, s, b in debts:
-            text += a.name + " doit " + getAmountAsString(s) + u" à " + b.name + u"\n"
+            yield a.name + " doit " + getAmountAsString(s) + u" à " + b.name + u"\n"
         if len(debts) == 0:
-            text += u"Aucune dette.\n"
-        text += u"\n"
+            yield u"Aucune dette.\n"
+        yield u"\n"
 
-        return text
+    def getReport(self, executor=None):
+        return u"".join(self.iterReport(executor))
 
-    def getReport(self):
-        text = u"     %s\n" % self.name
-        text += u"   %s\n\n" % (u"-" * (len(self.name) + 4))
+    def getParallelReport(self, workers=None, useProcesses=True):
+        """
+            Return the report, the persons sections being rendered by a pool
+            of workers (processes, or threads), see iterReport.
+        """
+        if useProcesses:
+            return self.getReport(ForkingExecutor(workers))
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            return self.getReport(pool)
+        finally:
+            pool.close()
+            pool.join()
+
+    def getSortedPersons(self):
+        persons = list(self.getPersons())
+        persons.sort(lambda a, b: cmp(a.name, b.name))
+        return persons
+
+    def iterReport(self, executor=None):
+        """
+            Yield the report, chunk by chunk.
+
+            If an executor is given (anything with an ordered map method, like
+            a multiprocessing pool or a concurrent.futures executor), each
+            person section is rendered by renderPersonReport through it.
+        """
+        yield u"     %s\n" % self.name
+        yield u"   %s\n\n" % (u"-" * (len(self.name) + 4))
         allItems = self.getItemsPerPerson()
         allPayments = self.getPaymentsPerPerson()
         allRefunds = self.getRefundsPerPerson()
 
-        persons = list(self.getPersons())
-        persons.sort(lambda a, b: cmp(a.name, b.name))
-        for person in persons:
-            text += u" " + person.name + u"\n"
-            text +=  "=" * (len(person.name) + 2) + "\n"
-            solde = 0
-            try:
-                gdTotal, subText = self.getReportItems(allItems[person])
-                solde = -gdTotal
-                text += subText
-            except KeyError:
-                text += u"\n --- Pas de dépense ---\n"
-            try:
-                gdTotal, subText = self.getReportPayments(allPayments[person])
-                solde += gdTotal
-                text += subText
+        persons = self.getSortedPersons()
+        if executor is not None:
+            # Sets as lists: they keep their iteration order if pickled
+            def freeze(perPerson):
+                if perPerson is None:
+                    return None
+                return dict((key, list(elems) if isinstance(elems, set) else elems) for key, elems in perPerson.items())
+            # Only the keys of the refunds are used: their items and payments would bring the whole pot along
+            sections = [(type(self), person, freeze(allItems.get(person)), allPayments.get(person),
+                None if person not in allRefunds else dict.fromkeys(allRefunds[person])) for person in persons]
+            for section in executor.map(renderPersonReport, sections):
+                yield section
+        else:
+            for person in persons:
+                for chunk in self.iterPersonReport(person, allItems.get(person), allPayments.get(person), allRefunds.get(person)):
+                    yield chunk
+
+        if len(persons) == 0:
+            yield u"Aucune personne ne participe à ce pot commun.\n"
+        yield u"\n"
+
+        for chunk in self.iterDebtsReport():
+            yield chunk
+
+    @classmethod
+    def iterPersonReport(cls, person, items, payments, refunds):
+        """
+            Yield the report section of a person, given his items, payments
+            and refunds (as in the per-person index, None if he has none).
+        """
+        yield u" " + person.name + u"\n"
+        yield "=" * (len(person.name) + 2) + "\n"
+        solde = 0
+        if items is not None:
+            solde = -cls.getItemsTotal(items)
+            for chunk in cls.iterReportItems(items):
+                yield chunk
+        else:
+            yield u"\n --- Pas de dépense ---\n"
+
+        if payments is not None:
+            solde += cls.getPaymentsTotal(payments)
+            for chunk in cls.iterReportPayments(payments):
+                yield chunk
+        else:
+            yield u"\n +++ Pas de paiement +++\n"
+
+        if refunds is not None:
+            solde -= cls.getRefundsTotal(refunds)
+            for chunk in cls.iterReportRefunds(refunds):
+                yield chunk
+        else:
+            yield u"\n ~~~ Pas de remboursement ~~~\n"
+
+        yield u"\nSolde : " + getAmountAsString(solde) + u"\n\n"
+
+    def writeReport(self, stream, encoding=None, executor=None):
+        """
+            Write the report to a file-like object, chunk by chunk, encoded if encoding is given.
+        """
+        for chunk in self.iterReport(executor):
+            stream.write(chunk if encoding is None else chunk.encode(encoding))
+
+    def printReport(self):
+        import sys
+        self.writeReport(sys.stdout)
+        sys.stdout.write(u"\n")
 
-            except KeyError:
-                text += u"\n +++ Pas de paiement +++\n"
 
+def renderPersonReport(section):
+    """
+        Render a report section from a (DebtManager class, person, items,
+        payments, refunds) tuple. At module level to be usable by process pools.
+    """
+    cls, person, items, payments, refunds = section
+    return u"".join(cls.iterPersonReport(person, items, payments, refunds))
+
+
+# Function and arguments of the running ForkingExecutor.map, inherited by its processes
+forkedCall = None
+
+
+def callForked(index):
+    function, arguments = forkedCall
+    return function(arguments[index])
+
+
+class ForkingExecutor(object):
+    """
+        An executor whose map() forks a pool of processes once the arguments
+        are known: the processes inherit them, so that they are not pickled
+        (which would also change the iteration order of the sets, hence
+        the reports).
+
+        Where processes are not forked (Windows), a thread pool is used.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers
+
+    def map(self, function, arguments):
+        global forkedCall
+        from multiprocessing.pool import Pool, ThreadPool
+        import sys
+        arguments = list(arguments)
+        if len(arguments) == 0:
+            return []
+        forkedCall = (function, arguments)
+        pool = (ThreadPool if sys.platform == "win32" else Pool)(self.workers)
+        try:
+            return pool.map(callForked, range(len(arguments)))
+        finally:
+            pool.close()
+            pool.join()
+            forkedCall = None
+
+
+class PersonsRegistry(object):
+    """
+        Dense integer ids of the persons of a debt manager: the running totals
+        are kept in lists indexed by them, and mapped back to persons only
+        when returned.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.persons = []
+
+    def __len__(self):
+        return len(self.persons)
+
+    def getId(self, person):
+        try:
+            return self.ids[person]
+        except KeyError:
+            personId = self.ids[person] = len(self.persons)
+            self.persons.append(person)
+            return personId
+
+    def getPerson(self, personId):
+        return self.persons[personId]
+
+
+class EditSession(object):
+    """
+        The changes done in DebtManager.edit.
+    """
+    def __init__(self, debtManager):
+        self.debtManager = debtManager
+        # The transactions, and the state of each transaction, saved before their first change
+        self.transactions = None
+        self.states = {}
+        self.touched = set()
+
+    def saveTransactions(self):
+        if self.transactions is None:
+            self.transactions = frozenset(self.debtManager.transactions)
+
+    def saveState(self, transaction):
+        if transaction not in self.states:
+            self.states[transaction] = transaction.getState()
+
+    def validate(self):
+        for transaction in self.touched:
+            if transaction in self.debtManager.transactions:
+                transaction.validate()
+
+    def rollback(self):
+        transactions = self.debtManager.transactions
+        if self.transactions is not None:
+            transactions.difference_update(transactions - self.transactions)
+            transactions.update(self.transactions - transactions)
+        for transaction, state in self.states.items():
+            if transaction.getState() != state:
+                transaction.setState(state)
+
+    def commit(self):
+        debtManager = self.debtManager
+        if debtManager.incremental:
+            debtManager.updateLedger()
+        for transaction in self.touched:
+            for listener in list(debtManager.listeners):
+                listener.transactionChanged(transaction)
+        debtManager.notifyBalances()
+
+
+def countObjects(result):
+    """
+        Return the number of objects a phase produced: persons of totals, debts...
+    """
+    if isinstance(result, tuple) and len(result) > 0 and isinstance(result[0], dict):
+        result = result[0]
+    return len(result) if hasattr(result, "__len__") else 0
+
+
+class Profiler(object):
+    """
+        Call counts, cumulative wall time and objects counts of the
+        computation phases of a debt manager (see DebtManager.enableProfiling).
+
+        Times include the nested phases. Objects are what a phase produced
+        (persons of the totals, debts, persons of the index...), or the chunks
+        of text for the report phases. checkAndAdjustTotals is only called
+        for the transactions whose totals are not memoized yet.
+    """
+    PHASES = ("computeTotals", "updateLedger", "computeTransactionTotals", "checkAndAdjustTotals",
+        "computeBalances", "computeDebts", "settleBalances", "computeDateIndex", "computePerPersonIndex", "indexOutlay",
+        "getPaymentsOrItemsOrRefundsPerPerson", "iterPersonReport", "iterDebtsReport")
+    GENERATORS = ("iterPersonReport", "iterDebtsReport")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+
+    def record(self, phase, elapsed, objects):
+        stats = self.phases.get(phase)
+        if stats is None:
+            stats = self.phases[phase] = {"calls": 0, "time": 0.0, "objects": 0}
+        stats["calls"] += 1
+        stats["time"] += elapsed
+        stats["objects"] += objects
+
+    def wrap(self, phase, method):
+        if phase in self.GENERATORS:
+            return self.wrapGenerator(phase, method)
+        def profiled(*args, **kwargs):
+            start = time.time()
+            result = method(*args, **kwargs)
+            self.record(phase, time.time() - start, countObjects(result))
+            return result
+        return profiled
+
+    def wrapGenerator(self, phase, method):
+        def profiled(*args, **kwargs):
+            elapsed = 0.0
+            chunks = 0
+            iterator = method(*args, **kwargs)
             try:
-                gdTotal, subText = self.getReportRefunds(allRefunds[person])
-                solde -= gdTotal
-                text += subText
+                while True:
+                    start = time.time()
+                    try:
+                        chunk = iterator.next()
+                    except StopIteration:
+                        elapsed += time.time() - start
+                        break
+                    elapsed += time.time() - start
+                    chunks += 1
+                    yield chunk
+            finally:
+                self.record(phase, elapsed, chunks)
+        return profiled
+
+    def getStats(self):
+        """
+            Return {phase: {"calls", "time", "objects"}}, for the phases called.
+        """
+        return dict((phase, dict(stats)) for phase, stats in self.phases.items())
 
-            except KeyError:
-                text += u"\n ~~~ Pas de remboursement ~~~\n"
 
+class BudgetExceeded(Exception):
+    pass
 
-            text += u"\nSolde : " + getAmountAsString(solde) + u"\n\n"
 
-        if len(persons) == 0:
-            text += u"Aucune personne ne participe à ce pot commun.\n"
-        text += u"\n"
+class SettlementOptimizer(object):
+    """
+        Settle balances with as few transfers as possible.
+
+        A group of n persons whose balances sum to zero can always be settled
+        with n - 1 transfers, so the fewer transfers, the more zero-sum groups
+        the persons are split into. The optimizer:
+        - pairs a debtor and a creditor owing exactly the same amount,
+        - splits the others exactly with a dynamic programming over subsets
+          when they are at most DP_LIMIT,
+        - otherwise, peels off zero-sum groups of 3 then 4 persons (found by
+          hashing the sums of pairs) until the DP can take over.
+
+        Each group is then settled with DebtManager.settleBalances. When the
+        time or nodes budget is exhausted, the persons not grouped yet are
+        settled together, and the greedy result is returned if it is better.
+    """
+    DP_LIMIT = 12
+    CHECK_TIME_EVERY = 1024
+
+    def __init__(self, maxTime=None, maxNodes=None):
+        self.maxTime = maxTime
+        self.maxNodes = maxNodes
+
+    def spend(self, nodes=1):
+        self.nodes += nodes
+        if self.maxNodes is not None and self.nodes > self.maxNodes:
+            raise BudgetExceeded()
+        if self.maxTime is not None and self.nodes >= self.nextTimeCheck:
+            self.nextTimeCheck = self.nodes + self.CHECK_TIME_EVERY
+            if time.time() > self.deadline:
+                raise BudgetExceeded()
+
+    def settle(self, balances):
+        self.nodes = 0
+        self.nextTimeCheck = 0
+        if self.maxTime is not None:
+            self.deadline = time.time() + self.maxTime
+
+        greedy = DebtManager.settleBalances(balances)
+        remaining = [(name, amount) for name, amount in balances.items() if amount != 0]
+        groups = []
+        try:
+            remaining = self.extractPairs(remaining, groups)
+            while len(remaining) > self.DP_LIMIT:
+                group = self.findGroup(remaining, 3) or self.findGroup(remaining, 4)
+                if group is None:
+                    break
+                groups.append([remaining[i] for i in group])
+                remaining = [elem for i, elem in enumerate(remaining) if i not in group]
+            if len(remaining) <= self.DP_LIMIT:
+                groups.extend(self.splitExactly(remaining))
+                remaining = []
+        except BudgetExceeded:
+            pass
+        if len(remaining) > 0:
+            groups.append(remaining)
 
-        text += self.getDebtsReport()
+        debts = []
+        for group in groups:
+            debts.extend(DebtManager.settleBalances(dict(group)))
+        if len(debts) >= len(greedy):
+            return greedy
+        return tuple(debts)
 
-        return text
+    def extractPairs(self, remaining, groups):
+        """
+            Group debtors and creditors with opposite balances, return the others.
+        """
+        creditors = {}
+        for index, (name, amount) in enumerate(remaining):
+            if amount < 0:
+                creditors.setdefault(-amount, []).append(index)
+        paired = set()
+        for index, (name, amount) in enumerate(remaining):
+            self.spend()
+            if amount > 0 and len(creditors.get(amount, ())) > 0:
+                creditor = creditors[amount].pop(0)
+                groups.append([remaining[index], remaining[creditor]])
+                paired.update((index, creditor))
+        return [elem for index, elem in enumerate(remaining) if index not in paired]
+
+    def findGroup(self, remaining, size):
+        """
+            Return the indexes of size (3 or 4) persons whose balances sum to zero, or None.
+        """
+        amounts = [amount for name, amount in remaining]
+        if size == 3:
+            positions = {}
+            for index, amount in enumerate(amounts):
+                positions.setdefault(amount, []).append(index)
+            for i in range(len(amounts)):
+                for j in range(i + 1, len(amounts)):
+                    self.spend()
+                    for k in positions.get(-amounts[i] - amounts[j], ()):
+                        if k > j:
+                            return set((i, j, k))
+        else:
+            pairs = {}
+            for i in range(len(amounts)):
+                for j in range(i + 1, len(amounts)):
+                    self.spend()
+                    total = amounts[i] + amounts[j]
+                    for k, l in pairs.get(-total, ()):
+                        if len(set((i, j, k, l))) == 4:
+                            return set((i, j, k, l))
+                    pairs.setdefault(total, []).append((i, j))
+        return None
+
+    def splitExactly(self, remaining):
+        """
+            Split the persons into as many zero-sum groups as possible.
 
-    def printReport(self):
-        print self.getReport()
+            best[mask] is the maximum number of zero-sum groups a sequence of
+            the persons in mask can be cut into, each prefix being a union of
+            groups: best[mask] = max(best[mask - i]) + (sum(mask) == 0).
+        """
+        count = len(remaining)
+        if count == 0:
+            return []
+        self.spend(count << count)
+        amounts = [amount for name, amount in remaining]
+        full = (1 << count) - 1
+        sums = [0] * (full + 1)
+        best = [0] * (full + 1)
+        previous = [0] * (full + 1)
+        for mask in range(1, full + 1):
+            low = mask & -mask
+            sums[mask] = sums[mask ^ low] + amounts[low.bit_length() - 1]
+            bestCount = -1
+            for i in range(count):
+                bit = 1 << i
+                if mask & bit and best[mask ^ bit] > bestCount:
+                    bestCount = best[mask ^ bit]
+                    previous[mask] = mask ^ bit
+            best[mask] = bestCount + (1 if sums[mask] == 0 else 0)
+
+        groups = []
+        mask = full
+        groupMask = full
+        while mask != 0:
+            mask = previous[mask]
+            if sums[mask] == 0:
+                groups.append([remaining[i] for i in range(count) if (groupMask ^ mask) >> i & 1])
+                groupMask = mask
+        return groups
+
+
+def observedAttribute(name):
+    """
+        Return a property of a transaction, kept in the slot "_" + name,
+        telling the listeners of the transaction when set.
+    """
+    slot = "_" + name
+    def getAttribute(self):
+        return getattr(self, slot)
+    def setAttribute(self, value):
+        self.changing()
+        setattr(self, slot, value)
+        self.changed()
+    return property(getAttribute, setAttribute)
 
 
 class Transaction(object):
+    """
+        Listeners provide transactionChanged(transaction), called after each
+        change, and may provide transactionChanging(transaction), called
+        before.
+    """
+    __slots__ = ("_date", "listeners", "version", "_cache", "_cacheVersion", "_items", "_payments", "_persons",
+        "_batchDepth", "_batchChanged")
+
+    # Attributes saved by getState, besides the items, payments and persons
+    STATE_ATTRIBUTES = ("date",)
+
     def __init__(self, date):
+        self.listeners = set()
+        self.version = 0
+        self._cache = {}
+        self._cacheVersion = 0
+        self._batchDepth = 0
+        self._batchChanged = False
         self.date = date
         self.items = set()
         self.payments = set()
         self.persons = set()
 
+    def getItems(self):
+        return self._items
+
+    def setItems(self, items):
+        if items is getattr(self, "_items", None):
+            return
+        self._items = self.replaceElements(getattr(self, "_items", None), items)
+        self.changed()
+
+    items = property(getItems, setItems)
+
+    def getPayments(self):
+        return self._payments
+
+    def setPayments(self, payments):
+        if payments is getattr(self, "_payments", None):
+            return
+        self._payments = self.replaceElements(getattr(self, "_payments", None), payments)
+        self.changed()
+
+    payments = property(getPayments, setPayments)
+
+    def getPersonsSet(self):
+        return self._persons
+
+    def setPersonsSet(self, persons):
+        if persons is getattr(self, "_persons", None):
+            return
+        self._persons = ObservedSet(persons, self)
+        self.changed()
+
+    persons = property(getPersonsSet, setPersonsSet)
+
+    def replaceElements(self, old, elements):
+        """
+            Return the items or payments elements as an ObservedSet, owned by
+            this transaction instead of the old one.
+        """
+        if old is not None:
+            old.owner = None
+            for element in old:
+                element.owners.remove(self)
+        elements = ObservedSet(elements, self)
+        for element in elements:
+            element.owners.append(self)
+        return elements
+
+    date = observedAttribute("date")
+
+    def elementsChanging(self, elements):
+        self.changing()
+
+    def elementsAdded(self, elements, added):
+        if elements is not self._persons:
+            for element in added:
+                element.owners.append(self)
+        self.changed()
+
+    def elementsRemoved(self, elements, removed):
+        if elements is not self._persons:
+            for element in removed:
+                element.owners.remove(self)
+        self.changed()
+
+    def changing(self):
+        """
+            Called before any change of this transaction, its items and payments included.
+        """
+        for listener in list(self.listeners):
+            transactionChanging = getattr(listener, "transactionChanging", None)
+            if transactionChanging is not None:
+                transactionChanging(self)
+
+    def changed(self):
+        """
+            Called after any change of this transaction, its items and
+            payments included: they tell their owners when edited in place.
+        """
+        self.version += 1
+        if self._batchDepth > 0:
+            self._batchChanged = True
+            return
+        for listener in list(self.listeners):
+            listener.transactionChanged(self)
+
+    @contextmanager
+    def batch(self):
+        """
+            Tell the listeners once, at the end of the with block, about the changes done in it.
+        """
+        self._batchDepth += 1
+        try:
+            yield self
+        finally:
+            self._batchDepth -= 1
+            if self._batchDepth == 0 and self._batchChanged:
+                self._batchChanged = False
+                self.changed()
+
+    def getState(self):
+        """
+            Return what setState needs to restore this transaction as it is,
+            its items and payments edited in place included.
+        """
+        elementsStates = tuple((element, element.getState()) for element in list(self.items) + list(self.payments))
+        return (frozenset(self.items), frozenset(self.payments), frozenset(self.persons), elementsStates) + tuple(
+            getattr(self, name) for name in self.STATE_ATTRIBUTES)
+
+    def setState(self, state):
+        with self.batch():
+            for elements, saved in zip((self.items, self.payments, self.persons), state[:3]):
+                elements.difference_update(elements - saved)
+                elements.update(saved - elements)
+            for element, elementState in state[3]:
+                element.setState(elementState)
+            for name, value in zip(self.STATE_ATTRIBUTES, state[4:]):
+                setattr(self, name, value)
+            self.changed()
+
+    def validate(self):
+        """
+            Raise ValueError if the totals of this transaction can't be computed.
+        """
+        for element in list(self.items) + list(self.payments):
+            if len(element.persons) == 0:
+                raise ValueError("%r: an item or a payment has no person" % self)
+        if self.getBalance() != 0 and len(self.getPersons()) == 0:
+            raise ValueError("%r: nobody to share the difference between items and payments" % self)
+
+    def __getstate__(self):
+        return getSlotsState(self, ("_cache",))
+
+    def __setstate__(self, state):
+        setSlotsState(self, state)
+        self._cache = {}
+
+    def memoize(self, key, compute):
+        """
+            Return compute(), computed once per version of this transaction.
+        """
+        if self._cacheVersion != self.version:
+            self._cache = {}
+            self._cacheVersion = self.version
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = compute()
+            return value
+
     def addItem(self, item):
         warnings.warn("Use xxx.items.add instead", DeprecationWarning, stacklevel=2)
         self.items.add(item)
@@ -434,12 +1686,41 @@ class Transaction(object):
         self.payments.add(payment)
 
     def getPersons(self):
+        return self.memoize("persons", self.computePersons)
+
+    def computePersons(self):
         result = set(self.persons)
         for item in self.items:
             result.update(item.persons)
         for payment in self.payments:
             result.update(payment.persons)
-        return result
+        return frozenset(result)
+
+    def getItemsAmountsPerPerson(self):
+        """
+            Return {item: {person: amount}}. Must not be modified.
+        """
+        return self.memoize("itemsAmounts", lambda: dict((item, item.computeAmountPerPerson()) for item in self.items))
+
+    def getPaymentsAmountsPerPerson(self):
+        """
+            Return {payment: {person: amount}}. Must not be modified.
+        """
+        return self.memoize("paymentsAmounts", lambda: dict((payment, payment.computeAmountPerPerson()) for payment in self.payments))
+
+    def getTotals(self, adjust=None):
+        """
+            Return the items and payments totals per person, adjusted by
+            adjust (DebtManager.checkAndAdjustTotals by default). Must not be modified.
+        """
+        return self.memoize("totals", lambda: self.computeTotals(adjust))
+
+    def computeTotals(self, adjust=None):
+        if adjust is None:
+            adjust = DebtManager.checkAndAdjustTotals
+        itemsTotals = AbstractPayment.mergeAmounts(self.getItemsAmountsPerPerson().values())
+        paymentsTotals = AbstractPayment.mergeAmounts(self.getPaymentsAmountsPerPerson().values())
+        return adjust(self.getPersons(), itemsTotals, paymentsTotals)
 
     def addPersons(self, persons):
         if type(persons) in (type(""), type(u"")):
@@ -456,6 +1737,9 @@ class Transaction(object):
         return Payment(*args, **kwargs)
 
     def getItemsTotalAmount(self):
+        return self.memoize("itemsTotalAmount", self.computeItemsTotalAmount)
+
+    def computeItemsTotalAmount(self):
         amount = 0
         for item in self.items:
             amount += item.amount
@@ -463,6 +1747,9 @@ class Transaction(object):
         return amount
 
     def getPaymentsTotalAmount(self):
+        return self.memoize("paymentsTotalAmount", self.computePaymentsTotalAmount)
+
+    def computePaymentsTotalAmount(self):
         amount = 0
         for payment in self.payments:
             amount += payment.amount
@@ -489,34 +1776,50 @@ class Transaction(object):
 
 
 class Outlay(Transaction):
+    __slots__ = ("_label",)
+    STATE_ATTRIBUTES = ("date", "label")
+
     def __init__(self, date, label):
         Transaction.__init__(self, date)
         self.label = label
 
+    label = observedAttribute("label")
+
 
 class Refund(Transaction):
     """
         A direct refund, maybe partial.
     """
+    __slots__ = ("_debitPerson", "_creditPerson")
+    STATE_ATTRIBUTES = ("date", "debitPerson", "creditPerson")
+
+    debitPerson = observedAttribute("debitPerson")
+    creditPerson = observedAttribute("creditPerson")
+
     def __init__(self, date, debitPerson, amount, creditPerson):
         from datetime import datetime
         Transaction.__init__(self, date)
         self.update(date, debitPerson, amount, creditPerson)
 
     def update(self, date, debitPerson, amount, creditPerson):
-        self.items.clear()
-        self.payments.clear()
+        """
+            The listeners are told once, after the whole update.
+        """
+        with self.batch():
+            self.items.clear()
+            self.payments.clear()
 
-        item = self.getItem((creditPerson, ), "Remboursement de %s" % debitPerson, amount)
-        payment = self.getPayment((debitPerson, ), amount)
+            item = self.getItem((creditPerson, ), "Remboursement de %s" % debitPerson, amount)
+            payment = self.getPayment((debitPerson, ), amount)
 
-        self.items.add(item)
-        self.payments.add(payment)
+            self.items.add(item)
+            self.payments.add(payment)
 
-        self.date = date
+            self.date = date
 
-        self.debitPerson = debitPerson
-        self.creditPerson = creditPerson
+            self.debitPerson = debitPerson
+            self.creditPerson = creditPerson
+            self.changed()
 
     @property
     def label(self):
@@ -528,63 +1831,232 @@ class Refund(Transaction):
         print >>sys.stderr, self.payments
         return set(self.payments).pop().amount
 
+def apportion(amount, weights):
+    """
+        Split an integer amount exactly, by integer weights, with the
+        largest remainder method: each key gets the floor of its share, and
+        the cents left go to the keys with the largest remainders.
+
+        weights is a sequence of (key, weight), whose order breaks the ties:
+        with equal remainders, the first keys get the cents first.
+        Return {key: share}.
+    """
+    total = 0
+    for key, weight in weights:
+        total += weight
+    if total <= 0:
+        raise ZeroDivisionError("Nothing to split %d among" % amount)
+
+    shares = {}
+    remainders = []
+    left = amount
+    for position, (key, weight) in enumerate(weights):
+        share, remainder = divmod(amount * weight, total)
+        shares[key] = share
+        left -= share
+        if remainder > 0:
+            remainders.append((-remainder, position, key))
+    # 0 <= left < number of positive remainders
+    if left > 0:
+        for remainder, position, key in heapq.nsmallest(left, remainders):
+            shares[key] += 1
+    return shares
+
+
+def sortedPersons(persons):
+    """
+        Return the persons (or names) sorted by name: the order in which they
+        get the cents left by a split, whatever the order of a set of them.
+    """
+    return sorted(persons, key=lambda person: getattr(person, "name", person))
+
+
+# Groups of at most this number of persons are shared between items and payments
+SHARED_GROUP_MAX_SIZE = 8
+
+
+def getPersonsGroup(persons):
+    """
+        Return the persons as a frozenset, the same one for equal small groups.
+    """
+    group = frozenset(persons)
+    if len(group) > SHARED_GROUP_MAX_SIZE:
+        return group
+    # Persons are interned, and alive as long as the group is: their ids identify it
+    key = frozenset(id(person) for person in group)
+    shared = getPersonsGroup.registry.get(key)
+    if shared is not None and shared == group:
+        return shared
+    getPersonsGroup.registry[key] = group
+    return group
+
+getPersonsGroup.registry = weakref.WeakValueDictionary()
+
+
 class AbstractPayment(object):
-    def __init__(self, persons, amount):
+    """
+        persons is a frozenset, shared by equal small groups (see getPersonsGroup).
+        Setting the persons, the amount or the weights (or the label of an
+        item) tells the transactions holding the element.
+
+        The amount is split among the persons in equal shares, or by the
+        integer weights {person: weight} if given (2 shares for adults,
+        1 for children...), see apportion.
+    """
+    __slots__ = ("_persons", "_amount", "_weights", "owners")
+
+    def __init__(self, persons, amount, weights=None):
         for person in persons:
             if type(person) in (type(""), type(u"")):
                 raise ValueError("Persons should not be a string: %s." % person)
 
-        self.persons = set(persons)
-        self.amount = amount
+        # The transactions holding this element, told when it is edited in place
+        self.owners = []
+        self._persons = getPersonsGroup(persons)
+        self._amount = amount
+        self._weights = self.checkWeights(weights)
+
+    def checkWeights(self, weights):
+        if weights is not None:
+            weights = dict(weights)
+            if set(weights.keys()) != self.persons:
+                raise ValueError("Weights must be given for each person, and only them.")
+            if any(weight < 0 for weight in weights.values()) or sum(weights.values()) == 0:
+                raise ValueError("Weights must be positive or null, and not all null.")
+        return weights
+
+    # Slots saved by getState
+    STATE_SLOTS = ("_persons", "_amount", "_weights")
+
+    def getState(self):
+        return tuple(getattr(self, name) for name in self.STATE_SLOTS)
+
+    def setState(self, state):
+        """
+            Restore the state, without telling the owners (see Transaction.setState).
+        """
+        for name, value in zip(self.STATE_SLOTS, state):
+            setattr(self, name, value)
+
+    def changing(self):
+        for owner in list(self.owners):
+            owner.changing()
+
+    def changed(self):
+        for owner in list(self.owners):
+            owner.changed()
+
+    def getPersons(self):
+        return self._persons
+
+    def setPersons(self, persons):
+        persons = getPersonsGroup(persons)
+        if self._weights is not None and set(self._weights.keys()) != persons:
+            raise ValueError("Weights must be given for each person, and only them.")
+        self.changing()
+        self._persons = persons
+        self.changed()
+
+    persons = property(getPersons, setPersons)
+
+    def getAmount(self):
+        return self._amount
+
+    def setAmount(self, amount):
+        self.changing()
+        self._amount = amount
+        self.changed()
+
+    amount = property(getAmount, setAmount)
+
+    def getWeights(self):
+        return self._weights
+
+    def setWeights(self, weights):
+        weights = self.checkWeights(weights)
+        self.changing()
+        self._weights = weights
+        self.changed()
+
+    weights = property(getWeights, setWeights)
+
+    def __getstate__(self):
+        return getSlotsState(self)
+
+    def __setstate__(self, state):
+        setSlotsState(self, state)
+        self._persons = getPersonsGroup(self._persons)
 
     @staticmethod
     def computeTotals(payments):
+        return AbstractPayment.mergeAmounts(payment.computeAmountPerPerson() for payment in payments)
+
+    @staticmethod
+    def mergeAmounts(amountsPerPerson):
+        """
+            Sum {person: amount} dicts into a new one.
+        """
         results = {}
-        for payment in payments:
-            for person, amount in payment.computeAmountPerPerson().items():
-                if person in results.keys():
-                    results[person] += amount
-                else:
-                    results[person] = amount
+        for amounts in amountsPerPerson:
+            for person, amount in amounts.iteritems():
+                results[person] = results.get(person, 0) + amount
         return results
 
     @staticmethod
     def mergeTotals(totalsA, totalsB):
-        for name, amount in totalsB.items():
-            if name in totalsA.keys():
-                totalsA[name] += amount
-            else:
-                totalsA[name] = amount
+        for name, amount in totalsB.iteritems():
+            totalsA[name] = totalsA.get(name, 0) + amount
         return totalsA
 
     def computeAmountPerPerson(self):
-        results = {}
         divisor = len(self.persons)
         if divisor == 0:
             raise ValueError((u"%s : aucune personne affectée à cette dépense" % self.label).encode("utf-8"))
-            
-        roundingError = self.amount - ((self.amount // divisor) * divisor)
-        for person in self.persons:
-            amount = self.amount // divisor + (1 if roundingError > 0 else 0)
-            roundingError -= 1
-            results[person] = amount
-        return results
 
+        weights = self.weights
+        if weights is None:
+            return apportion(self.amount, [(person, 1) for person in sortedPersons(self.persons)])
+        return apportion(self.amount, [(person, weights[person]) for person in sortedPersons(self.persons)])
+
+    def getShareLabel(self, person):
+        """
+            Return the part of the person, as "1/3", or None if he is alone.
+        """
+        if self.weights is not None:
+            return u"%d/%d" % (self.weights[person], sum(self.weights.values()))
+        if len(self.persons) > 1:
+            return u"1/%d" % len(self.persons)
+        return None
 
     def __eq__(self, other):
         if not isinstance(other, type(self)):
             return False
         if self.amount != other.amount:
             return False
+        if self.weights != other.weights:
+            return False
         return self.persons == other.persons
 
 class Payment(AbstractPayment):
-    pass
+    __slots__ = ()
 
 class Item(AbstractPayment):
-    def __init__(self, persons, label, amount):
-        AbstractPayment.__init__(self, persons, amount)
-        self.label = label
+    __slots__ = ("_label",)
+    STATE_SLOTS = AbstractPayment.STATE_SLOTS + ("_label",)
+
+    def __init__(self, persons, label, amount, weights=None):
+        AbstractPayment.__init__(self, persons, amount, weights)
+        self._label = label
+
+    def getLabel(self):
+        return self._label
+
+    def setLabel(self, label):
+        self.changing()
+        self._label = label
+        self.changed()
+
+    label = property(getLabel, setLabel)
 
     def __eq__(self, other):
         if not AbstractPayment.__eq__(self, other):
@@ -593,14 +2065,32 @@ class Item(AbstractPayment):
         return self.label == other.label
 
 class Person(object):
-    def __init__(self, name):
+    """
+        Persons are interned: Person(name) returns the living person with this name if any.
+    """
+    __slots__ = ("name", "__weakref__")
+
+    registry = weakref.WeakValueDictionary()
+
+    def __new__(cls, name):
         if type(name) == type(""):
-            self.name = name.decode("utf-8")
-        elif type(name) == type(u""):
-            self.name = name
-        else:
+            name = name.decode("utf-8")
+        elif type(name) != type(u""):
             raise ValueError("name should be a string!")
 
+        person = cls.registry.get((cls, name))
+        if person is None:
+            person = object.__new__(cls)
+            person.name = name
+            cls.registry[(cls, name)] = person
+        return person
+
+    def __init__(self, name):
+        pass
+
+    def __reduce__(self):
+        return (type(self), (self.name,))
+
     def __hash__(self):
         return hash(self.name)
 
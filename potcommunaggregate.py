@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    Balances of many pots (a season of trips with the same group), netted
+    before being settled once.
+
+    A pot is anything with a computeBalances method: a DebtManager, a
+    BinaryPot, or a StoredPot, loaded from its storage only by the process
+    computing its balances.
+"""
+from potcommun import DebtManager, AbstractPayment, SettlementOptimizer, ForkingExecutor
+
+
+class StoredPot(object):
+    """
+        A pot kept by a storage, opened as factory(*args):
+        - a handler, then loaded with load(name), or load() without name:
+          StoredPot(SQLiteHandler, ("pots.sqlite",), "Trip"), StoredPot(JournalHandler, ("trip",)),
+        - or anything computing the balances itself: StoredPot(BinaryPot, ("trip.pot",)).
+    """
+    def __init__(self, factory, args=(), name=None):
+        self.factory = factory
+        self.args = args
+        self.name = name
+
+    def computeBalances(self):
+        storage = self.factory(*self.args)
+        try:
+            if hasattr(storage, "computeBalances"):
+                return storage.computeBalances()
+            debtManager = storage.load() if self.name is None else storage.load(self.name)
+            return debtManager.computeBalances()
+        finally:
+            if hasattr(storage, "close"):
+                storage.close()
+
+
+def computePotBalances(pot):
+    return pot.computeBalances()
+
+
+class InProcessExecutor(object):
+    def map(self, function, arguments):
+        return [function(argument) for argument in arguments]
+
+
+class PotsAggregator(object):
+    """
+        Combined balances and debts of several pots.
+
+        The balances of the pots are computed in parallel by a pool of
+        workers processes (forked, so that the pots are not pickled), then
+        summed per person, and settled once.
+    """
+    def __init__(self, pots=(), workers=None, useProcesses=True):
+        self.pots = list(pots)
+        self.workers = workers
+        self.useProcesses = useProcesses
+
+    def add(self, pot):
+        self.pots.append(pot)
+
+    def getExecutor(self):
+        if self.useProcesses and len(self.pots) > 1:
+            return ForkingExecutor(self.workers)
+        return InProcessExecutor()
+
+    def computeBalancesPerPot(self, executor=None):
+        """
+            Return the balances of each pot, in the pots order.
+        """
+        if executor is None:
+            executor = self.getExecutor()
+        return list(executor.map(computePotBalances, self.pots))
+
+    def computeBalances(self, executor=None):
+        return reduce(AbstractPayment.mergeTotals, self.computeBalancesPerPot(executor), {})
+
+    def computeDebts(self, executor=None):
+        return DebtManager.settleBalances(self.computeBalances(executor))
+
+    def computeMinimalDebts(self, maxTime=0.1, maxNodes=None, executor=None):
+        """
+            Like computeDebts, with as few transfers as possible (see SettlementOptimizer).
+        """
+        return SettlementOptimizer(maxTime, maxNodes).settle(self.computeBalances(executor))
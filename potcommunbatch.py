@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Settle many stored pots, spread over a pool of processes.
+
+    Usage: python potcommunbatch.py [--report] [--workers N] [--output DIR] source...
+
+    A source is:
+    - a binary pot file (see potcommunbinary),
+    - a SQLite database (see SQLiteHandler): all its pots,
+    - a journal directory (see JournalHandler),
+    - a directory holding any of them,
+    - or a manifest: a text file listing sources, one per line ("#" starts a
+      comment). A line "database.sqlite:name" selects one pot of a database.
+
+    For each pot, the debts ([[debtor, amount, creditor], ...], amounts in
+    cents) are written to OUTPUT/<pot>.json, or the report to OUTPUT/<pot>.txt
+    with --report, <pot> being the path of the pot from the directory of its
+    source (and its name in a database). OUTPUT/summary.json lists the pots,
+    with the time taken by each and their errors.
+
+    The storage modules are imported only by the processes which need them.
+"""
+import os
+import re
+import sys
+import json
+import time
+
+SQLITE_MAGIC = "SQLite format 3\0"
+JOURNAL_SNAPSHOT = "snapshot.json"
+
+
+def getFileKind(path):
+    from potcommunbinary import MAGIC
+    with open(path, "rb") as sourceFile:
+        header = sourceFile.read(16)
+    if header.startswith(MAGIC):
+        return "binary"
+    if header.startswith(SQLITE_MAGIC):
+        return "sqlite"
+    return "manifest"
+
+
+def getSQLitePotNames(path):
+    import sqlite3
+    connection = sqlite3.connect(path)
+    try:
+        return [row[0] for row in connection.execute("SELECT name FROM pots ORDER BY name")]
+    finally:
+        connection.close()
+
+
+def findPots(source):
+    """
+        Yield (kind, path, pot name) for each pot of a source; kind is "binary",
+        "sqlite", "journal" or "missing", the name is None for a single pot source.
+    """
+    if os.path.isdir(source):
+        if os.path.exists(os.path.join(source, JOURNAL_SNAPSHOT)):
+            yield "journal", source, None
+            return
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if os.path.isdir(path) or getFileKind(path) != "manifest":
+                for pot in findPots(path):
+                    yield pot
+        return
+
+    if not os.path.exists(source) and ":" in source:
+        path, name = source.rsplit(":", 1)
+        if os.path.isfile(path) and getFileKind(path) == "sqlite":
+            yield "sqlite", path, name.decode("utf-8")
+            return
+    if not os.path.exists(source):
+        # Reported as an error of this pot
+        yield "missing", source, None
+        return
+
+    kind = getFileKind(source)
+    if kind == "binary":
+        yield kind, source, None
+    elif kind == "sqlite":
+        import sqlite3
+        try:
+            names = getSQLitePotNames(source)
+        except sqlite3.Error:
+            # Reported as an error of this pot, by loadPot
+            names = [None]
+        for name in names:
+            yield kind, source, name
+    else:
+        directory = os.path.dirname(source)
+        with open(source) as manifest:
+            for line in manifest:
+                line = line.split("#", 1)[0].strip()
+                if len(line) > 0:
+                    for pot in findPots(os.path.join(directory, line)):
+                        yield pot
+
+
+def getOutputName(source, path, name):
+    """
+        Return a file name (without extension) for the outputs of a pot:
+        its path relative to the directory of its source, and its name.
+    """
+    outputName = os.path.relpath(path, os.path.dirname(os.path.normpath(source)) or os.curdir)
+    if name is not None:
+        outputName += "-" + name.encode("utf-8")
+    return re.sub(r"[^\w.-]", "_", outputName)
+
+
+def getTasks(sources, output, report):
+    """
+        Return the tasks of settlePot, and the summaries of the sources which could not be read.
+    """
+    tasks = []
+    errors = []
+    outputNames = set()
+    for source in sources:
+        try:
+            pots = list(findPots(source))
+        except Exception, e:
+            errors.append({"kind": "source", "path": source, "name": None, "output": None,
+                "error": "%s: %s" % (type(e).__name__, e), "seconds": 0.0})
+            continue
+        for kind, path, name in pots:
+            outputName = getOutputName(source, path, name)
+            # Same pot given twice, or names made equal by the replaced characters
+            index = 1
+            while outputName in outputNames:
+                index += 1
+                outputName = "%s-%d" % (getOutputName(source, path, name), index)
+            outputNames.add(outputName)
+            tasks.append((kind, path, name, os.path.join(output, outputName), report))
+    return tasks, errors
+
+
+def loadPot(kind, path, name):
+    """
+        Return the pot: a BinaryPot, or a DebtManager.
+    """
+    if kind == "missing":
+        raise IOError("No such pot: %s" % path)
+    if kind == "binary":
+        from potcommunbinary import BinaryPot
+        return BinaryPot(path)
+    if kind == "sqlite":
+        if name is None:
+            # The pots of the database could not be listed: raise why
+            getSQLitePotNames(path)
+            raise KeyError("No pot in %s" % path)
+        from potcommunstorage import SQLiteHandler
+        handler = SQLiteHandler(path)
+        try:
+            return handler.load(name)
+        finally:
+            handler.close()
+    from potcommunstorage import JournalHandler
+    return JournalHandler(path).load()
+
+
+def settlePot(task):
+    """
+        Settle one pot, write its output, and return its summary.
+    """
+    kind, path, name, outputPath, report = task
+    summary = {"kind": kind, "path": path, "name": name, "output": None, "error": None}
+    start = time.time()
+    try:
+        pot = loadPot(kind, path, name)
+        try:
+            if report:
+                # The binary format computes the debts, but has no report
+                debtManager = pot.toDebtManager() if kind == "binary" else pot
+                summary["output"] = outputPath + ".txt"
+                with open(summary["output"], "w") as outputFile:
+                    debtManager.writeReport(outputFile, "utf-8")
+            else:
+                debts = pot.computeDebts()
+                summary["debts"] = len(debts)
+                summary["output"] = outputPath + ".json"
+                with open(summary["output"], "w") as outputFile:
+                    json.dump([[debtor.name, amount, creditor.name] for debtor, amount, creditor in debts], outputFile)
+        finally:
+            if kind == "binary":
+                pot.close()
+    except Exception, e:
+        summary["error"] = "%s: %s" % (type(e).__name__, e)
+    summary["seconds"] = time.time() - start
+    return summary
+
+
+def settlePots(sources, output, report=False, workers=None):
+    """
+        Settle the pots of the sources, and return the summary.
+    """
+    from multiprocessing import Pool, cpu_count
+    start = time.time()
+    tasks, errors = getTasks(sources, output, report)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    if workers is None:
+        workers = cpu_count()
+    pool = Pool(workers)
+    try:
+        pots = pool.map(settlePot, tasks, max(1, len(tasks) // (workers * 4)))
+    finally:
+        pool.close()
+        pool.join()
+    pots = errors + pots
+    summary = {"workers": workers, "seconds": time.time() - start, "pots": pots,
+        "errors": len([pot for pot in pots if pot["error"] is not None])}
+    with open(os.path.join(output, "summary.json"), "w") as summaryFile:
+        json.dump(summary, summaryFile, indent=2)
+    return summary
+
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(description="Settle many stored pots.")
+    parser.add_argument("sources", nargs="+", help="binary pots, SQLite databases, journal directories, directories or manifests")
+    parser.add_argument("--report", action="store_true", help="write the reports instead of the debts")
+    parser.add_argument("--workers", type=int, help="number of processes (default: one per CPU)")
+    parser.add_argument("--output", default="settlements", help="directory of the outputs (default: settlements)")
+    options = parser.parse_args(args)
+    summary = settlePots(options.sources, options.output, options.report, options.workers)
+    print "%d pots settled in %.3f s by %d processes, %d errors" % (
+        len(summary["pots"]), summary["seconds"], summary["workers"], summary["errors"])
+    return 1 if summary["errors"] > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks of the debt manager.
+
+    Usage:
+    python potcommunbench.py [number of persons...]
+    python potcommunbench.py --trips [--seed N] [--output results.json] [scale...]
+"""
+import sys
+import json
+import random
+import resource
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Process, Queue
+
+from potcommun import DebtManager, Person, Item, Payment, Outlay, Refund
+
+
+def getRandomBalances(personsCount, seed=0):
+    """
+        Return balances of personsCount persons, summing to zero.
+    """
+    rand = random.Random(seed)
+    balances = {}
+    total = 0
+    for i in range(personsCount - 1):
+        amount = rand.randint(-50000, 50000)
+        balances[Person(u"Person %d" % i)] = amount
+        total += amount
+    balances[Person(u"Person %d" % (personsCount - 1))] = -total
+    return balances
+
+
+def timeCall(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def benchSettlement(personsCount):
+    balances = getRandomBalances(personsCount)
+    heapTime, heapDebts = timeCall(DebtManager.settleBalances, balances)
+    sortTime, sortDebts = timeCall(DebtManager.settleBalancesBySorting, balances)
+    assert heapDebts == sortDebts
+    print "settlement, %6d persons: heaps %8.3f s, sorting %8.3f s (x%.0f)" % (
+        personsCount, heapTime, sortTime, sortTime / max(heapTime, 1e-6))
+
+
+class LegacyItem(object):
+    """
+        Items as they were stored before __slots__: a __dict__ and a set each.
+    """
+    def __init__(self, persons, label, amount):
+        self.persons = set(persons)
+        self.amount = amount
+        self.label = label
+
+
+def buildItems(itemClass, itemsCount, seed=0):
+    rand = random.Random(seed)
+    persons = [Person(u"Person %d" % i) for i in range(20)]
+    labels = [u"Label %d" % i for i in range(50)]
+    return [itemClass(rand.sample(persons, rand.randint(1, 4)), rand.choice(labels), rand.randint(1, 10000))
+        for i in xrange(itemsCount)]
+
+
+def runAndMeasure(queue, function, args):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = function(*args)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+    del result
+
+
+def measureMemory(function, *args):
+    """
+        Return the peak memory growth (in kB) of function(*args), run in a new process.
+    """
+    queue = Queue()
+    process = Process(target=runAndMeasure, args=(queue, function, args))
+    process.start()
+    growth = queue.get()
+    process.join()
+    return growth
+
+
+def benchItemsMemory(itemsCount):
+    legacy = measureMemory(buildItems, LegacyItem, itemsCount)
+    current = measureMemory(buildItems, Item, itemsCount)
+    print "memory, %8d items: slots %8d kB, legacy %8d kB (x%.1f)" % (
+        itemsCount, current, legacy, legacy / float(max(current, 1)))
+
+
+def generateTrip(personsCount=10, outlaysCount=100, itemsPerOutlay=5, groupSizes=(1, 4), refundRatio=0.1, seed=0):
+    """
+        Return a debt manager filled with a synthetic trip, always the same for a given seed.
+
+        Each outlay has itemsPerOutlay items, each shared by a random group of
+        groupSizes[0] to groupSizes[1] persons, and is paid by one or two
+        persons, sometimes a bit more than the items (a tip shared by the
+        persons of the outlay). refundRatio is the number of refunds per outlay.
+    """
+    rand = random.Random(seed)
+    persons = [Person(u"Person %d" % i) for i in range(personsCount)]
+    minGroupSize, maxGroupSize = groupSizes[0], min(groupSizes[1], personsCount)
+    start = datetime(2010, 1, 1)
+    debtManager = DebtManager("trip")
+    transactions = []
+    for i in xrange(outlaysCount):
+        outlay = Outlay(start + timedelta(hours=i), u"Outlay %d" % i)
+        total = 0
+        groupPersons = set()
+        for j in xrange(itemsPerOutlay):
+            group = rand.sample(persons, rand.randint(minGroupSize, maxGroupSize))
+            groupPersons.update(group)
+            amount = rand.randint(100, 10000)
+            total += amount
+            outlay.items.add(Item(group, u"Item %d" % j, amount))
+        outlay.addPersons(groupPersons)
+        if rand.random() < 0.2:
+            total += rand.randint(1, 1000)
+        payers = rand.sample(persons, rand.randint(1, min(2, personsCount)))
+        paid = 0
+        for payer in payers[:-1]:
+            amount = rand.randint(0, total - paid)
+            outlay.payments.add(Payment((payer,), amount))
+            paid += amount
+        outlay.payments.add(Payment((payers[-1],), total - paid))
+        transactions.append(outlay)
+
+        if personsCount > 1 and rand.random() < refundRatio:
+            debitPerson, creditPerson = rand.sample(persons, 2)
+            transactions.append(Refund(start + timedelta(hours=i, minutes=30), debitPerson, rand.randint(100, 5000), creditPerson))
+    debtManager.transactions.update(transactions)
+    return debtManager
+
+
+TRIP_SCALES = {
+    "small": dict(personsCount=5, outlaysCount=100, itemsPerOutlay=5),
+    "medium": dict(personsCount=20, outlaysCount=2000, itemsPerOutlay=5),
+    "large": dict(personsCount=100, outlaysCount=20000, itemsPerOutlay=8),
+}
+
+TRIP_OPERATIONS = ("computeTotals", "computeBalances", "computeDebts", "getItemsPerPerson", "getReport")
+
+
+def runTripBenchmark(queue, parameters, seed):
+    start = time.time()
+    debtManager = generateTrip(seed=seed, **parameters)
+    result = {"parameters": parameters, "generation": time.time() - start, "times": {}}
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for operation in TRIP_OPERATIONS:
+        # Each operation is timed on a fresh pot, without the caches filled by the others
+        debtManager = generateTrip(seed=seed, **parameters)
+        result["times"][operation] = timeCall(getattr(debtManager, operation))[0]
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peakMemory"] = usage
+    result["peakMemoryGrowth"] = usage - before
+    queue.put(result)
+
+
+def benchTrips(scales, seed=0):
+    """
+        Time the main operations on synthetic trips, each scale in a new process.
+
+        Return {scale: {"parameters", "generation", "times": {operation: seconds},
+        "peakMemory", "peakMemoryGrowth"}}, memory in kB.
+    """
+    results = {}
+    for scale in scales:
+        parameters = TRIP_SCALES[scale] if scale in TRIP_SCALES else json.loads(scale)
+        queue = Queue()
+        process = Process(target=runTripBenchmark, args=(queue, parameters, seed))
+        process.start()
+        results[scale] = queue.get()
+        process.join()
+        print "trip %s: %s, peak %d kB" % (scale,
+            ", ".join("%s %.3f s" % (operation, results[scale]["times"][operation]) for operation in TRIP_OPERATIONS),
+            results[scale]["peakMemory"])
+    return results
+
+
+def benchTripsMain(args):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark of synthetic trips.")
+    parser.add_argument("scales", nargs="*", default=["small", "medium", "large"],
+        help="%s, or generateTrip arguments as JSON" % ", ".join(sorted(TRIP_SCALES)))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file of the results")
+    options = parser.parse_args(args)
+    results = {"seed": options.seed, "date": datetime.now().isoformat(), "scales": benchTrips(options.scales, options.seed)}
+    if options.output is not None:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--trips":
+        benchTripsMain(sys.argv[2:])
+        sys.exit(0)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    for size in sizes:
+        benchSettlement(size)
+    for size in (100000, 1000000):
+        benchItemsMemory(size)
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+    Compact binary file format for a debt manager, read through mmap.
+
+    The file is a header followed by little-endian columns, each starting on
+    an 8 bytes boundary:
+    - a string table (offsets then UTF-8 data) holding names and labels,
+    - the persons, as string indexes,
+    - the transactions: kind, date (microseconds since 1970, or NO_DATE),
+      label, refund debit and credit persons and amount, and the offsets of
+      their elements, persons and participating persons,
+    - the elements (items and payments, grouped per transaction): kind,
+      label, amount and offsets of their persons,
+    - the persons lists, as person indexes.
+
+    The persons of elements and transactions are stored sorted by name (the
+    order of the cents left by the divisions, see sortedPersons), so that
+    BinaryPot computes exactly the same totals, balances and debts as the
+    DebtManager, without building any Item or Payment. Weighted elements
+    are not supported. Objects are built only for the transactions asked for.
+"""
+import mmap
+import struct
+from datetime import datetime, timedelta
+
+from potcommun import DebtManager, Transaction, Outlay, Refund, Item, Payment, Person, sortedPersons
+
+MAGIC = "POTCOMM1"
+NONE = 0xFFFFFFFF
+NO_DATE = -2 ** 63
+EPOCH = datetime(1970, 1, 1)
+
+KIND_TRANSACTION = 0
+KIND_OUTLAY = 1
+KIND_REFUND = 2
+
+# Name, struct type of each column, in file order
+COLUMNS = (
+    ("stringOffsets", "Q"),
+    ("stringData", "s"),
+    ("persons", "I"),
+    ("transactionKinds", "B"),
+    ("transactionDates", "q"),
+    ("transactionLabels", "I"),
+    ("refundDebitPersons", "I"),
+    ("refundCreditPersons", "I"),
+    ("refundAmounts", "q"),
+    ("transactionElementOffsets", "Q"),
+    ("transactionPersonOffsets", "Q"),
+    ("transactionPersons", "I"),
+    ("transactionOwnPersonOffsets", "Q"),
+    ("transactionOwnPersons", "I"),
+    ("elementIsPayment", "B"),
+    ("elementLabels", "I"),
+    ("elementAmounts", "q"),
+    ("elementPersonOffsets", "Q"),
+    ("elementPersons", "I"),
+)
+
+# Magic, pot name string index, then (offset, length) of each column
+HEADER = struct.Struct("<8sI4x" + "QQ" * len(COLUMNS))
+
+
+def dateToInt(date):
+    if date is None:
+        return NO_DATE
+    delta = date - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def intToDate(value):
+    if value == NO_DATE:
+        return None
+    return EPOCH + timedelta(microseconds=value)
+
+
+def writeBinaryPot(debtManager, path):
+    """
+        Write the debt manager in the binary format. Dates must be datetime objects or None.
+    """
+    strings = []
+    stringsIndexes = {}
+    def getStringIndex(text):
+        if text is None:
+            return NONE
+        if type(text) == type(""):
+            text = text.decode("utf-8")
+        if text not in stringsIndexes:
+            stringsIndexes[text] = len(strings)
+            strings.append(text)
+        return stringsIndexes[text]
+
+    persons = []
+    personsIndexes = {}
+    def getPersonIndex(person):
+        if person not in personsIndexes:
+            personsIndexes[person] = len(persons)
+            persons.append(getStringIndex(person.name))
+        return personsIndexes[person]
+
+    columns = dict((name, []) for name, structType in COLUMNS)
+    columns["transactionElementOffsets"].append(0)
+    columns["transactionPersonOffsets"].append(0)
+    columns["transactionOwnPersonOffsets"].append(0)
+    columns["elementPersonOffsets"].append(0)
+    potName = getStringIndex(debtManager.name)
+
+    for transaction in debtManager.transactions:
+        if isinstance(transaction, Refund):
+            kind, label = KIND_REFUND, None
+            refund = (getPersonIndex(transaction.debitPerson), getPersonIndex(transaction.creditPerson), transaction.amount)
+        else:
+            kind = KIND_OUTLAY if isinstance(transaction, Outlay) else KIND_TRANSACTION
+            label = transaction.label if kind == KIND_OUTLAY else None
+            refund = (NONE, NONE, 0)
+        columns["transactionKinds"].append(kind)
+        columns["transactionDates"].append(dateToInt(transaction.date))
+        columns["transactionLabels"].append(getStringIndex(label))
+        columns["refundDebitPersons"].append(refund[0])
+        columns["refundCreditPersons"].append(refund[1])
+        columns["refundAmounts"].append(refund[2])
+
+        for isPayment, elements in ((0, transaction.items), (1, transaction.payments)):
+            for element in elements:
+                if element.weights is not None:
+                    raise ValueError("Weighted items or payments are not supported by the binary format")
+                columns["elementIsPayment"].append(isPayment)
+                columns["elementLabels"].append(NONE if isPayment else getStringIndex(element.label))
+                columns["elementAmounts"].append(element.amount)
+                columns["elementPersons"].extend(getPersonIndex(person) for person in sortedPersons(element.persons))
+                columns["elementPersonOffsets"].append(len(columns["elementPersons"]))
+        columns["transactionElementOffsets"].append(len(columns["elementIsPayment"]))
+        columns["transactionPersons"].extend(getPersonIndex(person) for person in sortedPersons(transaction.getPersons()))
+        columns["transactionPersonOffsets"].append(len(columns["transactionPersons"]))
+        columns["transactionOwnPersons"].extend(getPersonIndex(person) for person in transaction.persons)
+        columns["transactionOwnPersonOffsets"].append(len(columns["transactionOwnPersons"]))
+
+    columns["persons"] = persons
+    encoded = [text.encode("utf-8") for text in strings]
+    offsets = [0]
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    columns["stringOffsets"] = offsets
+    columns["stringData"] = "".join(encoded)
+
+    with open(path, "wb") as output:
+        output.write("\0" * HEADER.size)
+        position = HEADER.size
+        locations = []
+        for name, structType in COLUMNS:
+            position += -position % 8
+            output.seek(position)
+            values = columns[name]
+            if structType == "s":
+                data = values
+            else:
+                data = struct.pack("<%d%s" % (len(values), structType), *values)
+            output.write(data)
+            locations.extend((position, len(values)))
+            position += len(data)
+        output.seek(0)
+        output.write(HEADER.pack(MAGIC, potName, *locations))
+
+
+class BinaryPot(object):
+    """
+        A pot saved by writeBinaryPot, opened through mmap.
+    """
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.map, 0)
+        if header[0] != MAGIC:
+            raise ValueError("%s is not a binary pot" % path)
+        self.nameIndex = header[1]
+        self.locations = {}
+        for index, (name, structType) in enumerate(COLUMNS):
+            self.locations[name] = (structType, header[2 + 2 * index], header[3 + 2 * index])
+        self.persons = None
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def getColumnLocation(self, name):
+        """
+            Return the struct type, offset and length of a column.
+        """
+        return self.locations[name]
+
+    def getColumn(self, name, start=0, stop=None):
+        structType, offset, length = self.locations[name]
+        stop = length if stop is None else stop
+        if structType == "s":
+            return self.map[offset + start:offset + stop]
+        size = struct.calcsize(structType)
+        return struct.unpack_from("<%d%s" % (stop - start, structType), self.map, offset + start * size)
+
+    def getValue(self, name, index):
+        return self.getColumn(name, index, index + 1)[0]
+
+    def getString(self, index):
+        if index == NONE:
+            return None
+        start, stop = self.getColumn("stringOffsets", index, index + 2)
+        return self.getColumn("stringData", start, stop).decode("utf-8")
+
+    def getName(self):
+        return self.getString(self.nameIndex)
+
+    def getPersons(self):
+        if self.persons is None:
+            self.persons = [Person(self.getString(index)) for index in self.getColumn("persons")]
+        return self.persons
+
+    def getTransactionsCount(self):
+        return self.locations["transactionKinds"][2]
+
+    def computeTotalsLists(self):
+        """
+            Return the items and payments totals, indexed by person, and the
+            indexes of the persons participating in a transaction.
+        """
+        personsCount = self.locations["persons"][2]
+        itemsTotals = [0] * personsCount
+        paymentsTotals = [0] * personsCount
+
+        isPayment = self.getColumn("elementIsPayment")
+        amounts = self.getColumn("elementAmounts")
+        offsets = self.getColumn("elementPersonOffsets")
+        persons = self.getColumn("elementPersons")
+        transactionElementOffsets = self.getColumn("transactionElementOffsets")
+        transactionPersonOffsets = self.getColumn("transactionPersonOffsets")
+        transactionPersons = self.getColumn("transactionPersons")
+
+        for transaction in range(self.getTransactionsCount()):
+            missing = 0
+            for element in range(transactionElementOffsets[transaction], transactionElementOffsets[transaction + 1]):
+                start, stop = offsets[element], offsets[element + 1]
+                if stop == start:
+                    raise ValueError("An item or a payment has no person")
+                amount = amounts[element]
+                share, roundingError = divmod(amount, stop - start)
+                totals = paymentsTotals if isPayment[element] else itemsTotals
+                for position in range(start, stop):
+                    totals[persons[position]] += share + (1 if position - start < roundingError else 0)
+                missing += amount if isPayment[element] else -amount
+
+            # Same adjustment as DebtManager.checkAndAdjustTotals
+            if missing != 0:
+                start, stop = transactionPersonOffsets[transaction], transactionPersonOffsets[transaction + 1]
+                share, roundingError = divmod(missing, stop - start)
+                for position in range(start, stop):
+                    itemsTotals[transactionPersons[position]] += share + (1 if position - start < roundingError else 0)
+
+        return itemsTotals, paymentsTotals, set(transactionPersons)
+
+    def computeTotals(self):
+        itemsTotals, paymentsTotals, present = self.computeTotalsLists()
+        persons = self.getPersons()
+        items = {}
+        payments = {}
+        for index in present:
+            items[persons[index]] = itemsTotals[index]
+            payments[persons[index]] = paymentsTotals[index]
+        return items, payments
+
+    def computeBalances(self):
+        itemsTotals, paymentsTotals, present = self.computeTotalsLists()
+        persons = self.getPersons()
+        return dict((persons[index], itemsTotals[index] - paymentsTotals[index]) for index in present)
+
+    def computeDebts(self):
+        return DebtManager.settleBalances(self.computeBalances())
+
+    def getTransaction(self, index):
+        """
+            Build the transaction stored at this index, with its items and payments.
+        """
+        persons = self.getPersons()
+        kind = self.getValue("transactionKinds", index)
+        date = intToDate(self.getValue("transactionDates", index))
+        if kind == KIND_REFUND:
+            return Refund(date, persons[self.getValue("refundDebitPersons", index)],
+                self.getValue("refundAmounts", index), persons[self.getValue("refundCreditPersons", index)])
+        if kind == KIND_OUTLAY:
+            transaction = Outlay(date, self.getString(self.getValue("transactionLabels", index)))
+        else:
+            transaction = Transaction(date)
+
+        start, stop = self.getColumn("transactionOwnPersonOffsets", index, index + 2)
+        transaction.persons.update(persons[person] for person in self.getColumn("transactionOwnPersons", start, stop))
+
+        start, stop = self.getColumn("transactionElementOffsets", index, index + 2)
+        isPayment = self.getColumn("elementIsPayment", start, stop)
+        labels = self.getColumn("elementLabels", start, stop)
+        amounts = self.getColumn("elementAmounts", start, stop)
+        offsets = self.getColumn("elementPersonOffsets", start, stop + 1)
+        elementsPersons = self.getColumn("elementPersons", offsets[0], offsets[-1])
+        for element in range(stop - start):
+            elementPersons = [persons[person] for person in elementsPersons[offsets[element] - offsets[0]:offsets[element + 1] - offsets[0]]]
+            if isPayment[element]:
+                transaction.payments.add(Payment(elementPersons, amounts[element]))
+            else:
+                transaction.items.add(Item(elementPersons, self.getString(labels[element]), amounts[element]))
+        return transaction
+
+    def toDebtManager(self):
+        debtManager = DebtManager(self.getName())
+        debtManager.transactions.update(self.getTransaction(index) for index in range(self.getTransactionsCount()))
+        return debtManager
+
+    def toColumnarPot(self):
+        """
+            Return a ColumnarPot built on the mapped columns (NumPy is required).
+        """
+        import numpy
+        from potcommuncolumns import ColumnarPot
+
+        def getArray(name):
+            structType, offset, length = self.locations[name]
+            if length == 0:
+                return numpy.zeros(0, dtype="<" + structType)
+            return numpy.frombuffer(self.map, dtype="<" + structType, count=length, offset=offset)
+
+        elementTransactions = numpy.repeat(numpy.arange(self.getTransactionsCount()), numpy.diff(getArray("transactionElementOffsets").astype(numpy.int64)))
+        return ColumnarPot(self.getPersons(), elementTransactions, getArray("elementAmounts"), getArray("elementIsPayment"),
+            getArray("elementPersonOffsets"), getArray("elementPersons"), getArray("transactionPersonOffsets"), getArray("transactionPersons"))
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+    Columnar representation of a pot, computed with NumPy.
+
+    Persons are numbered, and items and payments ("elements") are stored as
+    arrays instead of objects:
+    - elemTransactions: index of the transaction of each element,
+    - elemAmounts: amount of each element, in cents,
+    - elemIsPayment: True for payments, False for items,
+    - elemOffsets / elemPersons: the persons of element e are
+      elemPersons[elemOffsets[e]:elemOffsets[e + 1]] (CSR layout),
+    - transactionOffsets / transactionPersons: the persons of each
+      transaction (as Transaction.getPersons()), with the same layout.
+
+    The persons of elements and transactions are sorted by name (see
+    sortedPersons), so that the cents left by the divisions go to the very
+    same persons: the results are identical to the DebtManager ones.
+    Weighted elements are not supported.
+
+    NumPy is required by this module only.
+"""
+from array import array
+
+import numpy
+
+from potcommun import DebtManager, sortedPersons
+
+# Sums of absolute values below this are exact in float64, so bincount may be used.
+EXACT_FLOAT_LIMIT = 2 ** 53
+
+
+def sumPerIndex(indexes, values, length):
+    """
+        Return the int64 array of the sums of values per index.
+    """
+    if len(values) == 0 or numpy.abs(values).sum() < EXACT_FLOAT_LIMIT:
+        return numpy.bincount(indexes, weights=values, minlength=length).astype(numpy.int64)
+    result = numpy.zeros(length, dtype=numpy.int64)
+    numpy.add.at(result, indexes, values)
+    return result
+
+
+def arrayToNumpy(values, dtype):
+    if len(values) == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.frombuffer(values, dtype=dtype)
+
+
+def splitAmounts(amounts, offsets):
+    """
+        Split each amount among its persons in equal shares, like apportion:
+        the first (amount % count) persons get one more cent.
+
+        Return the share of each person entry, aligned on the persons array.
+    """
+    counts = numpy.diff(offsets)
+    safeCounts = numpy.maximum(counts, 1)
+    quotients = amounts // safeCounts
+    remainders = amounts - quotients * safeCounts
+    owners = numpy.repeat(numpy.arange(len(amounts)), counts)
+    ranks = numpy.arange(offsets[-1]) - offsets[:-1][owners]
+    return quotients[owners] + (ranks < remainders[owners])
+
+
+class ColumnarPot(object):
+    def __init__(self, persons, elemTransactions, elemAmounts, elemIsPayment, elemOffsets, elemPersons, transactionOffsets, transactionPersons):
+        self.persons = list(persons)
+        self.elemTransactions = numpy.asarray(elemTransactions, dtype=numpy.int64)
+        self.elemAmounts = numpy.asarray(elemAmounts, dtype=numpy.int64)
+        self.elemIsPayment = numpy.asarray(elemIsPayment, dtype=bool)
+        self.elemOffsets = numpy.asarray(elemOffsets, dtype=numpy.int64)
+        self.elemPersons = numpy.asarray(elemPersons, dtype=numpy.int64)
+        self.transactionOffsets = numpy.asarray(transactionOffsets, dtype=numpy.int64)
+        self.transactionPersons = numpy.asarray(transactionPersons, dtype=numpy.int64)
+
+    @classmethod
+    def fromDebtManager(cls, debtManager):
+        builder = ColumnarPotBuilder()
+        for transaction in debtManager.transactions:
+            for element in transaction.items | transaction.payments:
+                if element.weights is not None:
+                    raise ValueError("Weighted items or payments are not supported by ColumnarPot")
+            builder.addTransaction(sortedPersons(transaction.getPersons()),
+                [(sortedPersons(item.persons), item.amount) for item in transaction.items],
+                [(sortedPersons(payment.persons), payment.amount) for payment in transaction.payments])
+        return builder.build()
+
+    def getTransactionsCount(self):
+        return len(self.transactionOffsets) - 1
+
+    def computeElementsTotals(self):
+        """
+            Return the items totals, the payments totals (per person) and
+            the items and payments totals per transaction, before adjustment.
+        """
+        counts = numpy.diff(self.elemOffsets)
+        if numpy.any(counts == 0):
+            raise ValueError("An item or a payment has no person")
+        shares = splitAmounts(self.elemAmounts, self.elemOffsets)
+        sharesArePayments = numpy.repeat(self.elemIsPayment, counts)
+
+        personsCount = len(self.persons)
+        itemsTotals = sumPerIndex(self.elemPersons[~sharesArePayments], shares[~sharesArePayments], personsCount)
+        paymentsTotals = sumPerIndex(self.elemPersons[sharesArePayments], shares[sharesArePayments], personsCount)
+
+        transactionsCount = self.getTransactionsCount()
+        isPayment = self.elemIsPayment
+        transactionItems = sumPerIndex(self.elemTransactions[~isPayment], self.elemAmounts[~isPayment], transactionsCount)
+        transactionPayments = sumPerIndex(self.elemTransactions[isPayment], self.elemAmounts[isPayment], transactionsCount)
+        return itemsTotals, paymentsTotals, transactionItems, transactionPayments
+
+    def computeAdjustments(self, transactionItems, transactionPayments):
+        """
+            Vectorized DebtManager.checkAndAdjustTotals: split what is missing
+            from the items of each transaction among its persons.
+
+            Return the adjustment of the items totals per person.
+        """
+        missing = transactionPayments - transactionItems
+        counts = numpy.diff(self.transactionOffsets)
+        if numpy.any((counts == 0) & (missing != 0)):
+            raise ZeroDivisionError("A transaction has no person")
+        shares = splitAmounts(missing, self.transactionOffsets)
+        return sumPerIndex(self.transactionPersons, shares, len(self.persons))
+
+    def computeTotalsArrays(self):
+        """
+            Return the items and payments totals arrays, and the mask of the
+            persons participating in at least one transaction.
+        """
+        itemsTotals, paymentsTotals, transactionItems, transactionPayments = self.computeElementsTotals()
+        itemsTotals += self.computeAdjustments(transactionItems, transactionPayments)
+        present = numpy.bincount(self.transactionPersons, minlength=len(self.persons)) > 0
+        return itemsTotals, paymentsTotals, present
+
+    def computeTotals(self):
+        itemsTotals, paymentsTotals, present = self.computeTotalsArrays()
+        items = {}
+        payments = {}
+        for index in numpy.flatnonzero(present):
+            items[self.persons[index]] = int(itemsTotals[index])
+            payments[self.persons[index]] = int(paymentsTotals[index])
+        return items, payments
+
+    def computeBalancesArray(self):
+        itemsTotals, paymentsTotals, present = self.computeTotalsArrays()
+        return itemsTotals - paymentsTotals, present
+
+    def computeBalances(self):
+        balances, present = self.computeBalancesArray()
+        result = {}
+        for index in numpy.flatnonzero(present):
+            result[self.persons[index]] = int(balances[index])
+        return result
+
+    def computeDebts(self):
+        return DebtManager.settleBalances(self.computeBalances())
+
+
+class ColumnarPotBuilder(object):
+    """
+        Accumulate transactions into compact arrays, then build a ColumnarPot.
+    """
+    def __init__(self):
+        self.persons = []
+        self.personsIds = {}
+        self.elemTransactions = array("l")
+        self.elemAmounts = array("l")
+        self.elemIsPayment = array("b")
+        self.elemOffsets = array("l", [0])
+        self.elemPersons = array("l")
+        self.transactionOffsets = array("l", [0])
+        self.transactionPersons = array("l")
+
+    def getPersonId(self, person):
+        try:
+            return self.personsIds[person]
+        except KeyError:
+            self.personsIds[person] = len(self.persons)
+            self.persons.append(person)
+            return len(self.persons) - 1
+
+    def addTransaction(self, persons, items, payments):
+        """
+            persons: all the persons of the transaction, sorted by name.
+            items and payments: sequences of (persons sorted by name, amount).
+        """
+        transaction = len(self.transactionOffsets) - 1
+        for isPayment, elems in ((0, items), (1, payments)):
+            for elemPersons, amount in elems:
+                self.elemTransactions.append(transaction)
+                self.elemAmounts.append(amount)
+                self.elemIsPayment.append(isPayment)
+                self.elemPersons.extend(self.getPersonId(person) for person in elemPersons)
+                self.elemOffsets.append(len(self.elemPersons))
+        self.transactionPersons.extend(self.getPersonId(person) for person in persons)
+        self.transactionOffsets.append(len(self.transactionPersons))
+
+    def build(self):
+        return ColumnarPot(self.persons,
+            arrayToNumpy(self.elemTransactions, self.elemTransactions.typecode),
+            arrayToNumpy(self.elemAmounts, self.elemAmounts.typecode),
+            arrayToNumpy(self.elemIsPayment, numpy.int8),
+            arrayToNumpy(self.elemOffsets, self.elemOffsets.typecode),
+            arrayToNumpy(self.elemPersons, self.elemPersons.typecode),
+            arrayToNumpy(self.transactionOffsets, self.transactionOffsets.typecode),
+            arrayToNumpy(self.transactionPersons, self.transactionPersons.typecode))
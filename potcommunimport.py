@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+    Streaming import of receipts lines from CSV or JSON-lines files.
+
+    Each row is one line of a receipt:
+    - receipt: key of the receipt, rows with the same key go in the same outlay,
+    - date: date of the receipt (see dateFormat), may be empty,
+    - outlay: label of the outlay,
+    - type: "item", "payment", or "persons" (persons sharing what is not
+      detailed by the items),
+    - persons: names, separated by personsSeparator,
+    - label: label of the item,
+    - amount: as accepted by getAmountAsInt ("12,50 €"), or an integer number of cents in JSON.
+
+    Column names can be changed with the columns argument of ReceiptImporter.
+"""
+import csv
+import json
+from datetime import datetime
+
+from potcommun import Outlay, Item, Payment, Person, getAmountAsInt
+
+DEFAULT_COLUMNS = {
+    "receipt": "receipt",
+    "date": "date",
+    "outlay": "outlay",
+    "type": "type",
+    "persons": "persons",
+    "label": "label",
+    "amount": "amount",
+}
+
+
+def readCsvRows(stream, encoding="utf-8", **kwargs):
+    """
+        Yield (line number, row dict) for each row of a CSV file with a header line.
+    """
+    reader = csv.reader(stream, **kwargs)
+    header = [name.decode(encoding) for name in reader.next()]
+    for row in reader:
+        if len(row) == 0:
+            continue
+        yield reader.line_num, dict(zip(header, [cell.decode(encoding) for cell in row]))
+
+
+def readJsonLinesRows(stream):
+    """
+        Yield (line number, row dict) for each line of a JSON-lines file.
+
+        A line which is not valid JSON is yielded as a ValueError instead of a dict.
+    """
+    for lineNumber, line in enumerate(stream, 1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            yield lineNumber, json.loads(line)
+        except ValueError, e:
+            yield lineNumber, e
+
+
+class RowError(object):
+    def __init__(self, lineNumber, message):
+        self.lineNumber = lineNumber
+        self.message = message
+
+    def __repr__(self):
+        return "RowError(%d, %r)" % (self.lineNumber, self.message)
+
+
+class ImportResult(object):
+    def __init__(self):
+        self.rows = 0
+        self.outlays = 0
+        self.errors = []
+
+
+class ReceiptImporter(object):
+    """
+        Import receipts rows into a debt manager.
+
+        Rows are read one at a time. An outlay is inserted, by batches of
+        batchSize, once its receipt ends (rows of a receipt are expected to
+        be contiguous; rows of a receipt seen before are added to the
+        existing outlay). Persons are shared with those already in the
+        debt manager.
+
+        A wrong row is reported in the result errors, with its line number,
+        and the import goes on.
+    """
+    def __init__(self, debtManager, columns=None, dateFormat="%Y-%m-%d %H:%M", personsSeparator=";", batchSize=1000):
+        self.debtManager = debtManager
+        self.columns = dict(DEFAULT_COLUMNS)
+        self.columns.update(columns or {})
+        self.dateFormat = dateFormat
+        self.personsSeparator = personsSeparator
+        self.batchSize = batchSize
+        self.persons = dict((person.name, person) for person in debtManager.getPersons())
+        self.outlays = {}
+
+    def getPerson(self, name):
+        try:
+            return self.persons[name]
+        except KeyError:
+            person = self.persons[name] = Person(name)
+            return person
+
+    def getPersons(self, names):
+        if isinstance(names, (list, tuple)):
+            names = [name.strip() for name in names]
+        else:
+            names = [name.strip() for name in (names or u"").split(self.personsSeparator)]
+        return [self.getPerson(name) for name in names if len(name) > 0]
+
+    def getValue(self, row, column, default=None):
+        value = row.get(self.columns[column], default)
+        return default if value is None else value
+
+    def parseAmount(self, value):
+        if isinstance(value, (int, long)):
+            return value
+        try:
+            return getAmountAsInt(value.strip())
+        except (IndexError, AttributeError, ValueError):
+            raise ValueError("wrong amount: %r" % (value,))
+
+    def parseDate(self, value):
+        if value is None or len(value.strip()) == 0:
+            return None
+        try:
+            return datetime.strptime(value.strip(), self.dateFormat)
+        except ValueError:
+            raise ValueError("wrong date: %r" % (value,))
+
+    def importCsv(self, stream, **kwargs):
+        return self.importRows(readCsvRows(stream, **kwargs))
+
+    def importJsonLines(self, stream):
+        return self.importRows(readJsonLinesRows(stream))
+
+    def importRows(self, rows):
+        """
+            Import (line number, row) pairs, and return an ImportResult.
+        """
+        result = ImportResult()
+        batch = []
+        current = None
+        for lineNumber, row in rows:
+            result.rows += 1
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                if not isinstance(row, dict):
+                    raise ValueError("a row must be an object")
+                receipt = self.getValue(row, "receipt")
+                if receipt is None or len(unicode(receipt).strip()) == 0:
+                    raise ValueError("no receipt")
+
+                rowType, persons, label, amount = self.parseRow(row)
+                if receipt not in self.outlays:
+                    outlay = Outlay(self.parseDate(self.getValue(row, "date")), self.getValue(row, "outlay", u""))
+                    self.outlays[receipt] = outlay
+                    batch.append(outlay)
+                    result.outlays += 1
+                outlay = self.outlays[receipt]
+                if rowType == "persons":
+                    outlay.addPersons(persons)
+                elif rowType == "item":
+                    outlay.items.add(Item(persons, label, amount))
+                else:
+                    outlay.payments.add(Payment(persons, amount))
+            except Exception, e:
+                result.errors.append(RowError(lineNumber, unicode(e)))
+                continue
+
+            if receipt != current:
+                current = receipt
+                if len(batch) > self.batchSize:
+                    # The last outlay of the batch may still get rows
+                    self.debtManager.transactions.update(batch[:-1])
+                    batch = batch[-1:]
+
+        self.debtManager.transactions.update(batch)
+        return result
+
+    def parseRow(self, row):
+        """
+            Return the type, persons, label and amount of a row.
+        """
+        rowType = self.getValue(row, "type", u"item").strip().lower()
+        if rowType not in ("item", "payment", "persons"):
+            raise ValueError("wrong type: %r" % (rowType,))
+        persons = self.getPersons(self.getValue(row, "persons"))
+        if len(persons) == 0:
+            raise ValueError("no person")
+        if rowType == "persons":
+            return rowType, persons, None, None
+        return rowType, persons, self.getValue(row, "label", u""), self.parseAmount(self.getValue(row, "amount", u""))
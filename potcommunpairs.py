@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    Pairwise ledger: who fronted how much for whom.
+
+    In each transaction, what each payer paid is split among the consumers
+    (with apportion), in proportion to what they consumed (the adjusted
+    items total) and not paid for by the previous payers, so that the
+    amounts fronted sum up exactly to what each payer paid and each consumer
+    consumed. A refund is the debit person paying for the credit person.
+    The amounts fronted are netted per pair of persons, and kept in a sparse
+    {person: {counterparty: amount}} table.
+"""
+import heapq
+
+from potcommun import apportion, sortedPersons
+
+
+class PairwiseLedger(object):
+    """
+        Net debts between each pair of persons of a debt manager, kept up to
+        date as its transactions change (only the changed ones are computed
+        again, on the next query).
+
+        The amounts owed by a person to the counterparties sum up to the balance of the person.
+    """
+    def __init__(self, debtManager):
+        self.debtManager = debtManager
+        # {debtor: {creditor: amount}}, and the opposite amount for {creditor: {debtor: }}
+        self.net = {}
+        self.contributions = {}
+        self.dirty = set(debtManager.transactions)
+        debtManager.listeners.add(self)
+
+    def close(self):
+        self.debtManager.listeners.discard(self)
+
+    def transactionChanged(self, transaction):
+        self.dirty.add(transaction)
+
+    @staticmethod
+    def computeFronted(debtManager, transaction):
+        """
+            Return {(payer, consumer): amount} for one transaction.
+        """
+        itemsTotals, paymentsTotals = debtManager.computeTransactionTotals(transaction)
+        # A negative consumption (a reduction) counts as paid, a negative payment as consumed
+        paid = {}
+        consumed = {}
+        for person in itemsTotals:
+            paid[person] = max(paymentsTotals[person], 0) + max(-itemsTotals[person], 0)
+            consumed[person] = max(itemsTotals[person], 0) + max(-paymentsTotals[person], 0)
+
+        fronted = {}
+        persons = sortedPersons(itemsTotals)
+        for payer in persons:
+            if paid[payer] == 0:
+                continue
+            # What is left to pay of each consumption: the last payer pays it exactly
+            consumers = [(consumer, consumed[consumer]) for consumer in persons if consumed[consumer] > 0]
+            for consumer, amount in apportion(paid[payer], consumers).items():
+                consumed[consumer] -= amount
+                if payer != consumer and amount != 0:
+                    fronted[(payer, consumer)] = amount
+        return fronted
+
+    def applyFronted(self, fronted, sign):
+        for (payer, consumer), amount in fronted.items():
+            self.addOwed(consumer, payer, sign * amount)
+            self.addOwed(payer, consumer, -sign * amount)
+
+    def addOwed(self, debtor, creditor, amount):
+        counterparties = self.net.setdefault(debtor, {})
+        owed = counterparties.get(creditor, 0) + amount
+        if owed != 0:
+            counterparties[creditor] = owed
+            return
+        counterparties.pop(creditor, None)
+        if len(counterparties) == 0:
+            del self.net[debtor]
+
+    def update(self):
+        """
+            Fold the transactions changed since the last call into the table.
+        """
+        for transaction in list(self.dirty):
+            if transaction in self.contributions:
+                self.applyFronted(self.contributions.pop(transaction), -1)
+            if transaction in self.debtManager.transactions:
+                fronted = self.computeFronted(self.debtManager, transaction)
+                self.applyFronted(fronted, 1)
+                self.contributions[transaction] = fronted
+            self.dirty.discard(transaction)
+
+    def getOwed(self, debtor, creditor):
+        """
+            Return what debtor owes creditor directly (negative if creditor owes debtor).
+        """
+        self.update()
+        return self.net.get(debtor, {}).get(creditor, 0)
+
+    def getCounterparties(self, person):
+        """
+            Return {counterparty: amount owed by person} (negative when the counterparty owes).
+        """
+        self.update()
+        return dict(self.net.get(person, {}))
+
+    def getTopCounterparties(self, person, count):
+        """
+            Return the count (counterparty, amount owed by person) with the largest amounts,
+            in absolute value.
+        """
+        self.update()
+        return heapq.nlargest(count, self.net.get(person, {}).items(), key=lambda (counterparty, amount): (abs(amount), counterparty.name))
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+    Multi-pot service, with a local HTTP/JSON API.
+
+    Requests:
+    - GET /pots: names of the pots,
+    - POST /pots/<name>/transactions: add a transaction (see PotService.addTransaction),
+    - GET /pots/<name>/balances: {person: balance},
+    - GET /pots/<name>/debts: [[debtor, amount, creditor], ...],
+    - GET /pots/<name>/report: the text report.
+
+    Amounts are in cents, dates in ISO format.
+"""
+import json
+import threading
+import urllib
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
+
+from potcommun import DebtManager, Outlay, Refund, Item, Payment, Person
+from potcommunstorage import stringToDate
+
+
+class UnknownPot(KeyError):
+    pass
+
+
+class PotEntry(object):
+    def __init__(self, name):
+        self.name = name
+        # None until loaded by the first user of the entry
+        self.debtManager = None
+        self.lock = threading.Lock()
+        # Threads using or waiting for the pot: it can't be evicted meanwhile
+        self.users = 0
+
+
+class PotService(object):
+    """
+        Host many debt managers in one process.
+
+        Each pot has its own lock. At most maxPots pots are kept in memory:
+        the least recently used ones are saved to the handler and dropped,
+        then loaded again when needed. The handler must provide
+        save(debtManager) and load(name) (like SQLiteHandler); without
+        handler, pots are never evicted. Pots are loaded and saved with
+        their own lock held, not the lock of the service.
+
+        Reports are rendered by a pool of reportWorkers threads.
+    """
+    def __init__(self, handler=None, maxPots=100, reportWorkers=2):
+        self.handler = handler
+        self.maxPots = maxPots
+        self.pots = OrderedDict()
+        # Number of pots being saved before being dropped
+        self.evicting = 0
+        self.lock = threading.Lock()
+        self.handlerLock = threading.Lock()
+        self.executor = ThreadPool(reportWorkers)
+
+    def close(self):
+        self.executor.close()
+        self.executor.join()
+        with self.lock:
+            entries = list(self.pots.values())
+            self.pots.clear()
+        for entry in entries:
+            if entry.debtManager is not None:
+                self.save(entry.debtManager, forget=True)
+
+    def getPotNames(self):
+        with self.lock:
+            names = set(name for name, entry in self.pots.items() if entry.debtManager is not None)
+        if self.handler is not None:
+            with self.handlerLock:
+                names.update(self.handler.getPotNames())
+        return sorted(names)
+
+    def acquire(self, name, create=False):
+        """
+            Return the entry of a pot, with its lock acquired. Raise UnknownPot for an unknown pot.
+        """
+        with self.lock:
+            entry = self.pots.pop(name, None)
+            if entry is None:
+                entry = PotEntry(name)
+            self.pots[name] = entry
+            entry.users += 1
+        entry.lock.acquire()
+        try:
+            if entry.debtManager is None:
+                entry.debtManager = self.load(name, create)
+        except:
+            self.release(entry)
+            raise
+        self.evictOldPots()
+        return entry
+
+    def release(self, entry):
+        entry.lock.release()
+        with self.lock:
+            entry.users -= 1
+            # Forget an unknown pot
+            if entry.users == 0 and entry.debtManager is None and self.pots.get(entry.name) is entry:
+                del self.pots[entry.name]
+
+    def load(self, name, create):
+        debtManager = None
+        if self.handler is not None:
+            with self.handlerLock:
+                try:
+                    debtManager = self.handler.load(name)
+                except KeyError:
+                    pass
+        if debtManager is None:
+            if not create:
+                raise UnknownPot(name)
+            debtManager = DebtManager(name)
+        return debtManager
+
+    def save(self, debtManager, forget=False):
+        if self.handler is not None:
+            with self.handlerLock:
+                self.handler.save(debtManager)
+                if forget and hasattr(self.handler, "forget"):
+                    self.handler.forget(debtManager)
+
+    def evictOldPots(self):
+        """
+            Save and drop the least recently used pots beyond maxPots.
+        """
+        if self.handler is None:
+            return
+        victims = []
+        with self.lock:
+            excess = len(self.pots) - self.evicting - self.maxPots
+            for entry in list(self.pots.values())[:-1]:
+                if len(victims) >= excess:
+                    break
+                # Unused, loaded, and not being evicted by another thread
+                if entry.users == 0 and entry.debtManager is not None and entry.lock.acquire(False):
+                    victims.append(entry)
+            self.evicting += len(victims)
+        for entry in victims:
+            self.evict(entry)
+
+    def evict(self, entry):
+        """
+            Save a pot whose lock is held, then drop it unless it was asked for meanwhile.
+        """
+        saved = False
+        try:
+            self.save(entry.debtManager)
+            saved = True
+        finally:
+            with self.lock:
+                self.evicting -= 1
+                drop = saved and entry.users == 0 and self.pots.get(entry.name) is entry
+                if drop:
+                    del self.pots[entry.name]
+            try:
+                if drop and hasattr(self.handler, "forget"):
+                    with self.handlerLock:
+                        self.handler.forget(entry.debtManager)
+            finally:
+                entry.lock.release()
+
+    def call(self, name, function, create=False):
+        """
+            Return function(debtManager), called with the pot lock held.
+        """
+        entry = self.acquire(name, create)
+        try:
+            return function(entry.debtManager)
+        finally:
+            self.release(entry)
+
+    def addTransaction(self, name, data):
+        """
+            Add a transaction to a pot (created if needed), described as:
+            - an outlay: {"date", "label", "persons": [names],
+              "items": [{"persons", "label", "amount"}], "payments": [{"persons", "amount"}]},
+              items and payments may have "weights": {name: weight},
+            - a refund: {"type": "refund", "date", "debitPerson", "creditPerson", "amount"}
+            Return the number of transactions of the pot. Raise KeyError for
+            a missing field, ValueError for a wrong transaction.
+        """
+        transaction = self.buildTransaction(data)
+        transaction.validate()
+        def add(debtManager):
+            debtManager.transactions.add(transaction)
+            return len(debtManager.transactions)
+        return self.call(name, add, create=True)
+
+    @staticmethod
+    def buildTransaction(data):
+        date = stringToDate(data.get("date"))
+        if data.get("type", "outlay") == "refund":
+            return Refund(date, Person(data["debitPerson"]), int(data["amount"]), Person(data["creditPerson"]))
+        outlay = Outlay(date, data.get("label", u""))
+        outlay.addPersons(PotService.buildPersons(data.get("persons", [])))
+        for item in data.get("items", ()):
+            outlay.items.add(Item(PotService.buildPersons(item["persons"]), item.get("label", u""), int(item["amount"]),
+                PotService.buildWeights(item)))
+        for payment in data.get("payments", ()):
+            outlay.payments.add(Payment(PotService.buildPersons(payment["persons"]), int(payment["amount"]),
+                PotService.buildWeights(payment)))
+        return outlay
+
+    @staticmethod
+    def buildPersons(names):
+        # Like Transaction.addPersons: a string is not a list of names
+        if not isinstance(names, list):
+            raise ValueError("persons must be a list of names")
+        return [Person(name) for name in names]
+
+    @staticmethod
+    def buildWeights(data):
+        if data.get("weights") is None:
+            return None
+        if not isinstance(data["weights"], dict):
+            raise ValueError("weights must be an object")
+        return dict((Person(name), int(weight)) for name, weight in data["weights"].items())
+
+    def getBalances(self, name):
+        balances = self.call(name, lambda debtManager: debtManager.computeBalances())
+        return dict((person.name, amount) for person, amount in balances.items())
+
+    def getDebts(self, name):
+        debts = self.call(name, lambda debtManager: debtManager.computeDebts())
+        return [[debtor.name, amount, creditor.name] for debtor, amount, creditor in debts]
+
+    def getReport(self, name):
+        return self.call(name, lambda debtManager: self.executor.apply(debtManager.getReport))
+
+
+class PotRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def sendResponse(self, code, body, contentType="application/json"):
+        if contentType == "application/json":
+            body = json.dumps(body)
+        elif isinstance(body, unicode):
+            body = body.encode("utf-8")
+            contentType += "; charset=utf-8"
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def getPath(self):
+        parts = [urllib.unquote(part).decode("utf-8") for part in self.path.split("?")[0].split("/") if len(part) > 0]
+        if len(parts) == 0 or parts[0] != "pots":
+            return None
+        return parts[1:]
+
+    def respond(self, function):
+        try:
+            code, body, contentType = function()
+        except UnknownPot, e:
+            code, body, contentType = 404, {"error": u"unknown pot: %s" % e.args[0]}, "application/json"
+        except KeyError, e:
+            code, body, contentType = 400, {"error": u"missing field: %s" % e.args[0]}, "application/json"
+        except (ValueError, TypeError), e:
+            code, body, contentType = 400, {"error": unicode(e)}, "application/json"
+        except Exception, e:
+            self.log_error("%s: %s", type(e).__name__, e)
+            code, body, contentType = 500, {"error": "internal error"}, "application/json"
+        self.sendResponse(code, body, contentType)
+
+    def do_GET(self):
+        service = self.server.service
+        def get():
+            path = self.getPath()
+            if path == []:
+                return 200, service.getPotNames(), "application/json"
+            if path is not None and len(path) == 2:
+                name, what = path
+                if what == "balances":
+                    return 200, service.getBalances(name), "application/json"
+                if what == "debts":
+                    return 200, service.getDebts(name), "application/json"
+                if what == "report":
+                    return 200, service.getReport(name), "text/plain"
+            return 404, {"error": "not found"}, "application/json"
+        self.respond(get)
+
+    def do_POST(self):
+        service = self.server.service
+        def post():
+            path = self.getPath()
+            if path is None or len(path) != 2 or path[1] != "transactions":
+                return 404, {"error": "not found"}, "application/json"
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(data, dict):
+                raise ValueError("a transaction must be an object")
+            return 201, {"transactions": service.addTransaction(path[0], data)}, "application/json"
+        self.respond(post)
+
+
+class PotServer(ThreadingMixIn, HTTPServer):
+    """
+        HTTP server of a PotService, one thread per request. Use port 0 to get a free port.
+    """
+    daemon_threads = True
+
+    def __init__(self, service, host="127.0.0.1", port=0, verbose=False):
+        HTTPServer.__init__(self, (host, port), PotRequestHandler)
+        self.service = service
+        self.verbose = verbose
+
+    def getUrl(self):
+        return "http://%s:%d" % self.server_address
+
+
+if __name__ == "__main__":
+    import sys
+    from potcommunstorage import SQLiteHandler
+    path = sys.argv[1] if len(sys.argv) > 1 else "potcommun.sqlite"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    server = PotServer(PotService(SQLiteHandler(path, checkSameThread=False)), port=port, verbose=True)
+    print "Serving on %s" % server.getUrl()
+    try:
+        server.serve_forever()
+    finally:
+        server.service.close()
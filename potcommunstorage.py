@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+"""
+    Persistent save handlers for debt managers.
+"""
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+from potcommun import Handler, DebtManager, Transaction, Outlay, Refund, Item, Payment, Person, sortedPersons
+
+
+class ChangesTracker(object):
+    """
+        Listen to a debt manager, and remember the transactions changed since the last save.
+    """
+    def __init__(self, debtManager):
+        self.debtManager = debtManager
+        self.dirty = set()
+        debtManager.listeners.add(self)
+
+    def transactionChanged(self, transaction):
+        self.dirty.add(transaction)
+
+    def popChanges(self):
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
+    def close(self):
+        self.debtManager.listeners.discard(self)
+
+
+class SQLiteHandler(Handler):
+    """
+        SQLite save handler.
+
+        A database holds several pots, identified by their name. The first
+        save (or the load) of a pot writes (or reads) it completely; then
+        only the transactions added, removed or modified since are written,
+        in a single commit.
+
+        Dates are stored as timestamps: they must be datetime objects or None.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pots (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS persons (
+            id INTEGER PRIMARY KEY,
+            pot INTEGER NOT NULL REFERENCES pots (id),
+            name TEXT NOT NULL,
+            UNIQUE (pot, name)
+        );
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY,
+            pot INTEGER NOT NULL REFERENCES pots (id),
+            kind TEXT NOT NULL,
+            date TIMESTAMP,
+            label TEXT,
+            debit_person INTEGER REFERENCES persons (id),
+            credit_person INTEGER REFERENCES persons (id),
+            amount INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS transactions_pot ON transactions (pot);
+        CREATE TABLE IF NOT EXISTS transaction_persons (
+            transaction_id INTEGER NOT NULL REFERENCES transactions (id),
+            person INTEGER NOT NULL REFERENCES persons (id)
+        );
+        CREATE INDEX IF NOT EXISTS transaction_persons_transaction ON transaction_persons (transaction_id);
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY,
+            transaction_id INTEGER NOT NULL REFERENCES transactions (id),
+            label TEXT,
+            amount INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS items_transaction ON items (transaction_id);
+        CREATE TABLE IF NOT EXISTS item_persons (
+            item INTEGER NOT NULL REFERENCES items (id),
+            transaction_id INTEGER NOT NULL REFERENCES transactions (id),
+            person INTEGER NOT NULL REFERENCES persons (id),
+            weight INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS item_persons_transaction ON item_persons (transaction_id);
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY,
+            transaction_id INTEGER NOT NULL REFERENCES transactions (id),
+            amount INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS payments_transaction ON payments (transaction_id);
+        CREATE TABLE IF NOT EXISTS payment_persons (
+            payment INTEGER NOT NULL REFERENCES payments (id),
+            transaction_id INTEGER NOT NULL REFERENCES transactions (id),
+            person INTEGER NOT NULL REFERENCES persons (id),
+            weight INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS payment_persons_transaction ON payment_persons (transaction_id);
+    """
+
+    def __init__(self, path=":memory:", checkSameThread=True):
+        """
+            With checkSameThread False, the handler may be used from several
+            threads, provided the calls are serialized by the caller.
+        """
+        Handler.__init__(self)
+        self.connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=checkSameThread)
+        self.connection.executescript(self.SCHEMA)
+        self.upgradeSchema()
+        # Per debt manager: pot id, changes tracker, person ids and transaction ids
+        self.pots = {}
+
+    def upgradeSchema(self):
+        """
+            Add the weight columns (NULL for equal shares) to databases created without them.
+        """
+        with self.connection:
+            for table in ("item_persons", "payment_persons"):
+                columns = [row[1] for row in self.connection.execute("PRAGMA table_info(%s)" % table)]
+                if "weight" not in columns:
+                    self.connection.execute("ALTER TABLE %s ADD COLUMN weight INTEGER" % table)
+
+    def close(self):
+        for pot in self.pots.values():
+            pot["tracker"].close()
+        self.pots = {}
+        self.connection.close()
+
+    def forget(self, debtManager):
+        """
+            Stop tracking a debt manager: its next save will be a complete one.
+        """
+        pot = self.pots.pop(id(debtManager), None)
+        if pot is not None:
+            pot["tracker"].close()
+
+    def getPotId(self, name):
+        row = self.connection.execute("SELECT id FROM pots WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def getPotNames(self):
+        return [row[0] for row in self.connection.execute("SELECT name FROM pots ORDER BY name")]
+
+    def track(self, debtManager, potId, personsIds, transactionsIds):
+        pot = self.pots.get(id(debtManager))
+        if pot is not None:
+            pot["tracker"].close()
+        self.pots[id(debtManager)] = {
+            "id": potId,
+            "tracker": ChangesTracker(debtManager),
+            "persons": personsIds,
+            "transactions": transactionsIds,
+        }
+        return self.pots[id(debtManager)]
+
+    def save(self, debtManager):
+        with self.connection:
+            pot = self.pots.get(id(debtManager))
+            if pot is None or pot["tracker"].debtManager is not debtManager:
+                potId = self.getPotId(debtManager.name)
+                if potId is None:
+                    potId = self.connection.execute("INSERT INTO pots (name) VALUES (?)", (debtManager.name,)).lastrowid
+                else:
+                    self.deletePotContent(potId)
+                pot = self.track(debtManager, potId, {}, {})
+                changed = debtManager.transactions
+            else:
+                self.connection.execute("UPDATE pots SET name = ? WHERE id = ?", (debtManager.name, pot["id"]))
+                changed = pot["tracker"].popChanges()
+
+            removed = [transaction for transaction in changed if transaction not in debtManager.transactions]
+            self.deleteTransactions(pot, removed)
+            self.writeTransactions(pot, [transaction for transaction in changed if transaction in debtManager.transactions])
+
+    def load(self, name):
+        """
+            Return the debt manager saved with this name.
+        """
+        potId = self.getPotId(name)
+        if potId is None:
+            raise KeyError(name)
+        execute = self.connection.execute
+
+        persons = {}
+        for personId, personName in execute("SELECT id, name FROM persons WHERE pot = ?", (potId,)):
+            persons[personId] = Person(personName)
+
+        def getPersonsPerRow(table, column, weight="NULL"):
+            result = {}
+            query = "SELECT %s, person, %s FROM %s WHERE transaction_id IN (SELECT id FROM transactions WHERE pot = ?)" % (column, weight, table)
+            for rowId, personId, personWeight in execute(query, (potId,)):
+                result.setdefault(rowId, []).append((persons[personId], personWeight))
+            return result
+
+        def getWeights(personsAndWeights):
+            if any(weight is None for person, weight in personsAndWeights):
+                return None
+            return dict(personsAndWeights)
+
+        transactionsPersons = getPersonsPerRow("transaction_persons", "transaction_id")
+        itemsPersons = getPersonsPerRow("item_persons", "item", "weight")
+        paymentsPersons = getPersonsPerRow("payment_persons", "payment", "weight")
+
+        transactions = {}
+        for row in execute("SELECT id, kind, date, label, debit_person, credit_person, amount FROM transactions WHERE pot = ?", (potId,)):
+            transactionId, kind, date, label, debitPerson, creditPerson, amount = row
+            if kind == "refund":
+                transaction = Refund(date, persons[debitPerson], amount, persons[creditPerson])
+            else:
+                transaction = Outlay(date, label) if kind == "outlay" else Transaction(date)
+                transaction.persons.update(person for person, weight in transactionsPersons.get(transactionId, ()))
+            transactions[transactionId] = transaction
+
+        query = "SELECT id, transaction_id, label, amount FROM items WHERE transaction_id IN (SELECT id FROM transactions WHERE pot = ?)"
+        for itemId, transactionId, label, amount in execute(query, (potId,)):
+            transaction = transactions[transactionId]
+            if not isinstance(transaction, Refund):
+                personsAndWeights = itemsPersons.get(itemId, ())
+                transaction.items.add(Item([person for person, weight in personsAndWeights], label, amount, getWeights(personsAndWeights)))
+        query = "SELECT id, transaction_id, amount FROM payments WHERE transaction_id IN (SELECT id FROM transactions WHERE pot = ?)"
+        for paymentId, transactionId, amount in execute(query, (potId,)):
+            transaction = transactions[transactionId]
+            if not isinstance(transaction, Refund):
+                personsAndWeights = paymentsPersons.get(paymentId, ())
+                transaction.payments.add(Payment([person for person, weight in personsAndWeights], amount, getWeights(personsAndWeights)))
+
+        debtManager = DebtManager(name)
+        debtManager.transactions.update(transactions.values())
+        personsIds = dict((person, personId) for personId, person in persons.items())
+        transactionsIds = dict((transaction, transactionId) for transactionId, transaction in transactions.items())
+        self.track(debtManager, potId, personsIds, transactionsIds)
+        return debtManager
+
+    def purge(self):
+        with self.connection:
+            for table in ("payment_persons", "payments", "item_persons", "items", "transaction_persons", "transactions", "persons", "pots"):
+                self.connection.execute("DELETE FROM %s" % table)
+        for pot in self.pots.values():
+            pot["tracker"].close()
+        self.pots = {}
+
+    def deletePotContent(self, potId):
+        execute = self.connection.execute
+        for table in ("payment_persons", "payments", "item_persons", "items", "transaction_persons"):
+            execute("DELETE FROM %s WHERE transaction_id IN (SELECT id FROM transactions WHERE pot = ?)" % table, (potId,))
+        execute("DELETE FROM transactions WHERE pot = ?", (potId,))
+        execute("DELETE FROM persons WHERE pot = ?", (potId,))
+
+    def deleteTransactionsContent(self, transactionsIds):
+        rows = [(transactionId,) for transactionId in transactionsIds]
+        for table in ("payment_persons", "payments", "item_persons", "items", "transaction_persons"):
+            self.connection.executemany("DELETE FROM %s WHERE transaction_id = ?" % table, rows)
+
+    def deleteTransactions(self, pot, transactions):
+        ids = [pot["transactions"].pop(transaction) for transaction in transactions if transaction in pot["transactions"]]
+        self.deleteTransactionsContent(ids)
+        self.connection.executemany("DELETE FROM transactions WHERE id = ?", [(transactionId,) for transactionId in ids])
+
+    def getPersonId(self, pot, person):
+        try:
+            return pot["persons"][person]
+        except KeyError:
+            cursor = self.connection.execute("INSERT INTO persons (pot, name) VALUES (?, ?)", (pot["id"], person.name))
+            pot["persons"][person] = cursor.lastrowid
+            return cursor.lastrowid
+
+    def writeTransactions(self, pot, transactions):
+        """
+            Insert or rewrite transactions, with their items and payments.
+        """
+        execute = self.connection.execute
+        updated = [pot["transactions"][transaction] for transaction in transactions if transaction in pot["transactions"]]
+        self.deleteTransactionsContent(updated)
+
+        transactionsPersons = []
+        itemsPersons = []
+        paymentsPersons = []
+        for transaction in transactions:
+            if isinstance(transaction, Refund):
+                row = ("refund", transaction.date, transaction.label, self.getPersonId(pot, transaction.debitPerson),
+                    self.getPersonId(pot, transaction.creditPerson), transaction.amount)
+            elif isinstance(transaction, Outlay):
+                row = ("outlay", transaction.date, transaction.label, None, None, None)
+            else:
+                row = ("transaction", transaction.date, None, None, None, None)
+
+            transactionId = pot["transactions"].get(transaction)
+            if transactionId is None:
+                transactionId = execute("INSERT INTO transactions (pot, kind, date, label, debit_person, credit_person, amount) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (pot["id"],) + row).lastrowid
+                pot["transactions"][transaction] = transactionId
+            else:
+                execute("UPDATE transactions SET kind = ?, date = ?, label = ?, debit_person = ?, credit_person = ?, amount = ? WHERE id = ?",
+                    row + (transactionId,))
+
+            if isinstance(transaction, Refund):
+                continue
+            for person in transaction.persons:
+                transactionsPersons.append((transactionId, self.getPersonId(pot, person)))
+            for item in transaction.items:
+                itemId = execute("INSERT INTO items (transaction_id, label, amount) VALUES (?, ?, ?)", (transactionId, item.label, item.amount)).lastrowid
+                for person in item.persons:
+                    itemsPersons.append((itemId, transactionId, self.getPersonId(pot, person), self.getWeight(item, person)))
+            for payment in transaction.payments:
+                paymentId = execute("INSERT INTO payments (transaction_id, amount) VALUES (?, ?)", (transactionId, payment.amount)).lastrowid
+                for person in payment.persons:
+                    paymentsPersons.append((paymentId, transactionId, self.getPersonId(pot, person), self.getWeight(payment, person)))
+
+        self.connection.executemany("INSERT INTO transaction_persons (transaction_id, person) VALUES (?, ?)", transactionsPersons)
+        self.connection.executemany("INSERT INTO item_persons (item, transaction_id, person, weight) VALUES (?, ?, ?, ?)", itemsPersons)
+        self.connection.executemany("INSERT INTO payment_persons (payment, transaction_id, person, weight) VALUES (?, ?, ?, ?)", paymentsPersons)
+
+    @staticmethod
+    def getWeight(element, person):
+        return None if element.weights is None else element.weights[person]
+
+
+def dateToString(date):
+    return None if date is None else date.isoformat()
+
+
+def stringToDate(text):
+    if text is None:
+        return None
+    return datetime.strptime(text, "%Y-%m-%dT%H:%M:%S.%f" if "." in text else "%Y-%m-%dT%H:%M:%S")
+
+
+class JournalHandler(Handler):
+    """
+        Append-only journal save handler, for one pot.
+
+        The directory holds a snapshot of the pot, and the journal of the
+        events which happened since: addition, edition and removal of
+        transactions, items and payments, one JSON object per line. Each save
+        appends its events and is synced to disk once.
+
+        After compactEvery events, the journal is folded into a new snapshot.
+        Loading reads the snapshot, then replays the journal.
+
+        Dates are stored in ISO format: they must be datetime objects or None.
+    """
+    SNAPSHOT = "snapshot.json"
+    JOURNAL = "journal.jsonl"
+
+    def __init__(self, path, compactEvery=10000):
+        Handler.__init__(self)
+        self.path = path
+        self.compactEvery = compactEvery
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.untrack()
+
+    def getSnapshotPath(self):
+        return os.path.join(self.path, self.SNAPSHOT)
+
+    def getJournalPath(self):
+        return os.path.join(self.path, self.JOURNAL)
+
+    def untrack(self):
+        if getattr(self, "tracker", None) is not None:
+            self.tracker.close()
+        self.tracker = None
+        self.debtManager = None
+        self.nextId = 1
+        self.journalEvents = 0
+        # Per transaction: its id and signature
+        self.transactions = {}
+        # Per transaction id: {element: (id, signature)}
+        self.elements = {}
+
+    def getNewId(self):
+        self.nextId += 1
+        return self.nextId - 1
+
+    @staticmethod
+    def getTransactionRecord(transaction):
+        if isinstance(transaction, Refund):
+            return {"kind": "refund", "date": dateToString(transaction.date), "debitPerson": transaction.debitPerson.name,
+                "creditPerson": transaction.creditPerson.name, "amount": transaction.amount}
+        record = {"date": dateToString(transaction.date), "persons": sorted(person.name for person in transaction.persons)}
+        if isinstance(transaction, Outlay):
+            record.update(kind="outlay", label=transaction.label)
+        else:
+            record.update(kind="transaction")
+        return record
+
+    @staticmethod
+    def getElementRecord(element):
+        persons = sortedPersons(element.persons)
+        record = {"persons": [person.name for person in persons], "amount": element.amount}
+        if element.weights is not None:
+            record["weights"] = [element.weights[person] for person in persons]
+        if isinstance(element, Item):
+            record["label"] = element.label
+        return record
+
+    @staticmethod
+    def getElementKind(element):
+        return "Item" if isinstance(element, Item) else "Payment"
+
+    def getEvents(self, changed):
+        """
+            Compare the changed transactions with what has been journaled, and return the events.
+        """
+        events = []
+        for transaction in changed:
+            if transaction not in self.debtManager.transactions:
+                if transaction in self.transactions:
+                    transactionId = self.transactions.pop(transaction)[0]
+                    del self.elements[transactionId]
+                    events.append({"op": "removeTransaction", "id": transactionId})
+                continue
+
+            record = self.getTransactionRecord(transaction)
+            if transaction not in self.transactions:
+                transactionId = self.getNewId()
+                self.elements[transactionId] = {}
+                events.append(dict(record, op="addTransaction", id=transactionId))
+            else:
+                transactionId, oldRecord = self.transactions[transaction]
+                if record != oldRecord:
+                    events.append(dict(record, op="editTransaction", id=transactionId))
+            self.transactions[transaction] = (transactionId, record)
+
+            if isinstance(transaction, Refund):
+                continue
+            elements = self.elements[transactionId]
+            current = set(transaction.items) | set(transaction.payments)
+            for element in [element for element in elements if element not in current]:
+                elementId = elements.pop(element)[0]
+                events.append({"op": "remove" + self.getElementKind(element), "transaction": transactionId, "id": elementId})
+            for element in current:
+                elementRecord = self.getElementRecord(element)
+                if element not in elements:
+                    elements[element] = (self.getNewId(), elementRecord)
+                    events.append(dict(elementRecord, op="add" + self.getElementKind(element), transaction=transactionId, id=elements[element][0]))
+                elif elements[element][1] != elementRecord:
+                    elements[element] = (elements[element][0], elementRecord)
+                    events.append(dict(elementRecord, op="edit" + self.getElementKind(element), transaction=transactionId, id=elements[element][0]))
+        return events
+
+    def save(self, debtManager):
+        if self.debtManager is not debtManager:
+            self.untrack()
+            self.debtManager = debtManager
+            self.tracker = ChangesTracker(debtManager)
+            self.getEvents(debtManager.transactions)
+            self.compact()
+            return
+
+        events = self.getEvents(self.tracker.popChanges())
+        if debtManager.name != self.name:
+            self.name = debtManager.name
+            events.append({"op": "rename", "name": debtManager.name})
+        if len(events) == 0:
+            return
+        with open(self.getJournalPath(), "a") as journal:
+            for event in events:
+                journal.write(json.dumps(event) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.journalEvents += len(events)
+        if self.journalEvents >= self.compactEvery:
+            self.compact()
+
+    def compact(self):
+        """
+            Write a new snapshot of the tracked pot, and empty the journal.
+        """
+        transactions = []
+        for transaction, (transactionId, record) in self.transactions.items():
+            record = dict(record, id=transactionId, items=[], payments=[])
+            for element, (elementId, elementRecord) in self.elements[transactionId].items():
+                record[self.getElementKind(element).lower() + "s"].append(dict(elementRecord, id=elementId))
+            transactions.append(record)
+        self.name = self.debtManager.name
+        snapshot = {"name": self.name, "nextId": self.nextId, "transactions": transactions}
+
+        temporaryPath = self.getSnapshotPath() + ".tmp"
+        with open(temporaryPath, "w") as snapshotFile:
+            json.dump(snapshot, snapshotFile)
+            snapshotFile.flush()
+            os.fsync(snapshotFile.fileno())
+        os.rename(temporaryPath, self.getSnapshotPath())
+        with open(self.getJournalPath(), "w") as journal:
+            os.fsync(journal.fileno())
+        self.journalEvents = 0
+
+    def replay(self, transactions, event):
+        op = event.pop("op")
+        if op.endswith("Transaction"):
+            if op == "removeTransaction":
+                del transactions[event["id"]]
+            else:
+                previous = transactions.get(event["id"], {"items": [], "payments": []})
+                event.update(items=previous["items"], payments=previous["payments"])
+                transactions[event["id"]] = event
+        else:
+            elements = transactions[event.pop("transaction")]["items" if op.endswith("Item") else "payments"]
+            elements[:] = [element for element in elements if element["id"] != event["id"]]
+            if not op.startswith("remove"):
+                elements.append(event)
+
+    def load(self):
+        """
+            Return the saved debt manager.
+        """
+        with open(self.getSnapshotPath()) as snapshotFile:
+            snapshot = json.load(snapshotFile)
+        name = snapshot["name"]
+        nextId = snapshot["nextId"]
+        transactions = dict((record["id"], record) for record in snapshot["transactions"])
+
+        events = 0
+        if os.path.exists(self.getJournalPath()):
+            with open(self.getJournalPath(), "r+") as journal:
+                size = 0
+                for line in journal:
+                    if not line.endswith("\n"):
+                        # Interrupted write: drop it, so the next events are appended after the last good one
+                        journal.truncate(size)
+                        break
+                    size += len(line)
+                    event = json.loads(line)
+                    events += 1
+                    if event["op"] == "rename":
+                        name = event["name"]
+                        continue
+                    nextId = max(nextId, event["id"] + 1)
+                    self.replay(transactions, event)
+
+        persons = {}
+        def getPersons(names):
+            return [persons.setdefault(personName, Person(personName)) for personName in names]
+
+        def getWeights(elementRecord):
+            if "weights" not in elementRecord:
+                return None
+            return dict(zip(getPersons(elementRecord["persons"]), elementRecord["weights"]))
+
+        debtManager = DebtManager(name)
+        self.untrack()
+        for transactionId, record in transactions.items():
+            if record["kind"] == "refund":
+                debitPerson, creditPerson = getPersons((record["debitPerson"], record["creditPerson"]))
+                transaction = Refund(stringToDate(record["date"]), debitPerson, record["amount"], creditPerson)
+            else:
+                date = stringToDate(record["date"])
+                transaction = Outlay(date, record["label"]) if record["kind"] == "outlay" else Transaction(date)
+                transaction.persons.update(getPersons(record["persons"]))
+            elements = {}
+            for elementRecord in record["items"]:
+                item = Item(getPersons(elementRecord["persons"]), elementRecord["label"], elementRecord["amount"], getWeights(elementRecord))
+                transaction.items.add(item)
+                elements[item] = (elementRecord["id"], self.getElementRecord(item))
+            for elementRecord in record["payments"]:
+                payment = Payment(getPersons(elementRecord["persons"]), elementRecord["amount"], getWeights(elementRecord))
+                transaction.payments.add(payment)
+                elements[payment] = (elementRecord["id"], self.getElementRecord(payment))
+            debtManager.transactions.add(transaction)
+            self.transactions[transaction] = (transactionId, self.getTransactionRecord(transaction))
+            self.elements[transactionId] = elements
+
+        self.debtManager = debtManager
+        self.tracker = ChangesTracker(debtManager)
+        self.name = name
+        self.nextId = nextId
+        self.journalEvents = events
+        return debtManager
+
+    def purge(self):
+        self.untrack()
+        for path in (self.getSnapshotPath(), self.getJournalPath()):
+            if os.path.exists(path):
+                os.remove(path)
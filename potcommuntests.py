@@ -3,7 +3,8 @@
 from unittest import TestCase
 
 from datetime import datetime
-from potcommun import Handler, DebtManager, Item, Payment, Outlay, Person, Refund
+from potcommun import Handler, DebtManager, Item, Payment, Outlay, Person, Refund, SettlementOptimizer
+from potcommun import getAmountAsInt, getAmountAsString, getAmountsAsInt, getAmountsAsString, apportion
 
 class Tests(TestCase):
     def test_void(self):
@@ -297,7 +298,8 @@ class Tests(TestCase):
         outlay.payments.add(Payment((bob,), 3))
         outlay.addPersons((alice,))
         result = mgr.computeDebts()
-        expected = ((alice, 1, bob),)
+        # The cent left goes to the first person by name
+        expected = ((alice, 2, bob),)
         self.assertEqual(result, expected)
 
     def test_refunds(self):
@@ -510,3 +512,837 @@ class Tests(TestCase):
     def test_report(self):
         self.mgr.printReport()
 
+
+    def test_incremental_ledger(self):
+        mgr = DebtManager(incremental=False)
+        mgr.transactions = set(self.mgr.transactions)
+        self.assertEqual(self.mgr.computeTotals(), mgr.computeTotals())
+
+        carl = Person("Carl")
+        outlay = Outlay(datetime(2010, 3, 16, 12, 0, 0), "Lunch")
+        self.mgr.transactions.add(outlay)
+        mgr.transactions.add(outlay)
+        outlay.items.add(Item((self.alice, carl), "Pizza", 1500))
+        outlay.payments.add(Payment((carl,), 1500))
+        self.assertEqual(self.mgr.computeTotals(), mgr.computeTotals())
+        self.assertEqual(self.mgr.computeBalances(), mgr.computeBalances())
+
+        refund = Refund(datetime(2010, 3, 17, 12, 0, 0), self.alice, 750, carl)
+        self.mgr.transactions.add(refund)
+        mgr.transactions.add(refund)
+        refund.update(refund.date, self.bob, 300, carl)
+        self.assertEqual(self.mgr.computeBalances(), mgr.computeBalances())
+
+        self.mgr.transactions.remove(outlay)
+        self.mgr.transactions.remove(refund)
+        self.assertEqual(self.mgr.computeBalances(), {self.alice: -2500, self.bob: 2500})
+        self.assertFalse(carl in self.mgr.computeTotals()[0])
+
+    def test_incremental_ledger_in_place_edit(self):
+        self.assertEqual(self.mgr.computeBalances(), {self.alice: -2500, self.bob: 2500})
+        outlay = [t for t in self.mgr.transactions if t.label == "Cinema"][0]
+        payment = set(outlay.payments).pop()
+        payment.amount = 3000
+        self.assertEqual(self.mgr.computeBalances(), {self.alice: -2000, self.bob: 2000})
+        item = set(outlay.items).pop()
+        item.weights = {self.alice: 3, self.bob: 1}
+        self.assertEqual(self.mgr.computeBalances(), {self.alice: -1500, self.bob: 1500})
+
+        # Not told any more once removed
+        outlay.payments.remove(payment)
+        payment.amount = 100
+        self.assertEqual(self.mgr.computeBalances(), {self.alice: -3000, self.bob: 3000})
+        self.assertEqual(payment.owners, [])
+
+    def test_settle_balances_same_as_sorting(self):
+        from random import Random
+        rand = Random(42)
+        for count in (2, 3, 10, 50):
+            persons = [Person(u"P%d" % i) for i in range(count)]
+            balances = dict((p, rand.choice((-300, -100, 100, 200, 300))) for p in persons[:-1])
+            balances[persons[-1]] = -sum(balances.values())
+            self.assertEqual(DebtManager.settleBalances(balances), DebtManager.settleBalancesBySorting(balances))
+
+        self.assertRaises(RuntimeError, DebtManager.settleBalances, {self.alice: 100})
+
+    def test_minimal_debts(self):
+        a, b, c, d, e = [Person(name) for name in "abcde"]
+        balances = {a: -6, b: 5, c: 2, d: -5, e: 4}
+        self.assertEqual(len(DebtManager.settleBalances(balances)), 4)
+
+        result = SettlementOptimizer().settle(balances)
+        self.assertEqual(len(result), 3)
+        for debtor, amount, creditor in result:
+            balances[debtor] -= amount
+            balances[creditor] += amount
+        self.assertEqual(set(balances.values()), set((0,)))
+
+        balances = {a: -6, b: 5, c: 2, d: -5, e: 4}
+        self.assertEqual(SettlementOptimizer(maxNodes=0).settle(balances), DebtManager.settleBalances(balances))
+        self.assertEqual(self.mgr.computeMinimalDebts(), ((self.bob, 2500, self.alice),))
+
+    def test_per_person_index_follows_changes(self):
+        items = self.mgr.getItemsPerPerson()
+        self.assertTrue(self.mgr.getItemsPerPerson() is items)
+        self.mgr.computeBalances()
+
+        carl = Person("Carl")
+        outlay = Outlay(datetime(2010, 3, 16, 12, 0, 0), "Lunch")
+        outlay.addPersons((self.alice, carl))
+        outlay.payments.add(Payment((carl,), 1500))
+        self.mgr.transactions.add(outlay)
+        self.mgr.transactions.add(Refund(datetime(2010, 3, 17, 12, 0, 0), self.bob, 500, self.alice))
+
+        key = (datetime(2010, 3, 16, 12, 0, 0), "Lunch", 1500)
+        self.assertEqual(self.mgr.getItemsPerPerson()[carl], {key: set(((u"(1/2)", 750),))})
+        self.assertEqual(self.mgr.getPaymentsPerPerson()[carl], {key: set((1500,))})
+        self.assertEqual(self.mgr.getRefundsPerPerson()[self.alice].keys(), [(datetime(2010, 3, 17, 12, 0, 0), u"Remboursement de Bob", 500)])
+
+    def test_transaction_version_and_cache(self):
+        outlay = Outlay(datetime(2010, 3, 16, 12, 0, 0), "Lunch")
+        outlay.items.add(Item((self.alice,), "Pizza", 1000))
+        outlay.payments.add(Payment((self.bob,), 1200))
+        version = outlay.version
+        persons = outlay.getPersons()
+        self.assertTrue(outlay.getPersons() is persons)
+        self.assertEqual(outlay.getBalance(), 200)
+        self.assertEqual(outlay.getTotals(), ({self.alice: 1100, self.bob: 100}, {self.alice: 0, self.bob: 1200}))
+
+        carl = Person("Carl")
+        outlay.persons.add(carl)
+        self.assertTrue(outlay.version > version)
+        self.assertEqual(outlay.getPersons(), set((self.alice, self.bob, carl)))
+        outlay.items.add(Item((carl,), "Salad", 200))
+        self.assertEqual(outlay.getBalance(), 0)
+
+        # Elements edited in place bump the version too
+        mgr = DebtManager(incremental=False)
+        mgr.transactions.add(outlay)
+        salad = [item for item in outlay.items if item.label == "Salad"][0]
+        salad.amount = 100
+        self.assertEqual(outlay.getItemsTotalAmount(), 1100)
+        self.assertEqual(outlay.getBalance(), 100)
+        salad.persons = (self.bob,)
+        self.assertEqual(outlay.getTotals()[0], {self.alice: 1034, self.bob: 133, carl: 33})
+        self.assertEqual(mgr.computeBalances(), {self.alice: 1034, self.bob: -1067, carl: 33})
+        salad.label = "Soup"
+        self.assertEqual(mgr.getItemsPerPerson()[self.bob].values(), [set([(u"Soup", 100), (u"(1/3)", 33)])])
+        self.assertRaises(ValueError, setattr, Item((carl, self.bob), "Wine", 1001, {carl: 2, self.bob: 1}), "persons", (carl,))
+
+        refund = Refund(datetime(2010, 3, 17, 12, 0, 0), self.bob, 500, self.alice)
+        version = refund.version
+        refund.update(refund.date, self.bob, 500, carl)
+        self.assertTrue(refund.version > version)
+        self.assertEqual(refund.getPersons(), set((self.bob, carl)))
+
+    def test_columnar_pot(self):
+        try:
+            from potcommuncolumns import ColumnarPot
+        except ImportError:
+            self.skipTest("NumPy is not available")
+
+        carl = Person("Carl")
+        outlay = Outlay(datetime(2010, 3, 16, 12, 0, 0), "Lunch")
+        outlay.items.add(Item((self.alice, self.bob, carl), "Pizza", 1001))
+        outlay.payments.add(Payment((carl,), 1500))
+        self.mgr.transactions.add(outlay)
+        self.mgr.transactions.add(Refund(datetime(2010, 3, 17, 12, 0, 0), self.bob, 333, carl))
+
+        pot = ColumnarPot.fromDebtManager(self.mgr)
+        self.assertEqual(pot.computeTotals(), self.mgr.computeTotals())
+        self.assertEqual(pot.computeBalances(), self.mgr.computeBalances())
+        self.assertEqual(pot.computeDebts(), self.mgr.computeDebts())
+
+    def test_sqlite_handler(self):
+        from potcommunstorage import SQLiteHandler
+        handler = SQLiteHandler()
+        self.mgr.name = u"Montagne"
+        self.mgr.transactions.add(Refund(datetime(2010, 3, 16, 21, 0, 0), self.bob, 500, self.alice))
+        handler.save(self.mgr)
+
+        mgr = handler.load(u"Montagne")
+        self.assertEqual(mgr.computeDebts(), self.mgr.computeDebts())
+        self.assertEqual(mgr.getReport(), self.mgr.getReport())
+
+        carl = Person("Carl")
+        outlay = Outlay(datetime(2010, 3, 17, 12, 0, 0), "Lunch")
+        outlay.addPersons((self.alice, carl))
+        outlay.payments.add(Payment((carl,), 1500))
+        self.mgr.transactions.add(outlay)
+        cinema = [t for t in self.mgr.transactions if getattr(t, "label", None) == "Cinema"][0]
+        self.mgr.transactions.remove(cinema)
+        handler.save(self.mgr)
+
+        mgr = handler.load(u"Montagne")
+        self.assertEqual(mgr.computeDebts(), self.mgr.computeDebts())
+        self.assertEqual(len(mgr.transactions), 3)
+
+        outlay = [t for t in mgr.transactions if getattr(t, "label", None) == "Lunch"][0]
+        outlay.items.add(Item((carl,), "Salad", 300))
+        handler.save(mgr)
+        self.assertEqual(handler.load(u"Montagne").computeDebts(), mgr.computeDebts())
+
+        handler.purge()
+        self.assertEqual(handler.getPotNames(), [])
+
+    def test_journal_handler(self):
+        import tempfile
+        import shutil
+        from potcommunstorage import JournalHandler
+        path = tempfile.mkdtemp()
+        try:
+            handler = JournalHandler(path, compactEvery=8)
+            self.mgr.transactions.add(Refund(datetime(2010, 3, 16, 21, 0, 0), self.bob, 500, self.alice))
+            handler.save(self.mgr)
+            self.assertEqual(JournalHandler(path).load().getReport(), self.mgr.getReport())
+
+            carl = Person("Carl")
+            outlay = Outlay(datetime(2010, 3, 17, 12, 0, 0), "Lunch")
+            outlay.addPersons((self.alice, carl))
+            payment = Payment((carl,), 1500)
+            outlay.payments.add(payment)
+            self.mgr.transactions.add(outlay)
+            handler.save(self.mgr)
+            self.assertEqual(handler.journalEvents, 2)
+
+            payment.amount = 1800
+            outlay.changed()
+            outlay.items.add(Item((carl,), "Salad", 300))
+            cinema = [t for t in self.mgr.transactions if getattr(t, "label", None) == "Cinema"][0]
+            self.mgr.transactions.remove(cinema)
+            handler.save(self.mgr)
+            self.assertEqual(handler.journalEvents, 5)
+
+            mgr = JournalHandler(path).load()
+            self.assertEqual(mgr.getReport(), self.mgr.getReport())
+
+            # Interrupted write of the last event
+            with open(handler.getJournalPath(), "a") as journal:
+                journal.write('{"op": "removeTransac')
+            handler = JournalHandler(path, compactEvery=8)
+            mgr = handler.load()
+            self.assertEqual(mgr.computeDebts(), self.mgr.computeDebts())
+            mgr.name = u"Montagne"
+            handler.save(mgr)
+            self.assertEqual(JournalHandler(path).load().name, u"Montagne")
+
+            mgr.transactions.clear()
+            handler.save(mgr)
+            self.assertEqual(handler.journalEvents, 0)
+            self.assertEqual(JournalHandler(path).load().computeDebts(), ())
+        finally:
+            shutil.rmtree(path)
+
+    def test_binary_pot(self):
+        import os
+        import tempfile
+        from potcommunbinary import writeBinaryPot, BinaryPot
+        carl = Person(u"Cäsar")
+        outlay = Outlay(datetime(2010, 3, 16, 12, 0, 0, 500), u"Déjeuner")
+        outlay.items.add(Item((self.alice, self.bob, carl), "Pizza", 1001))
+        outlay.payments.add(Payment((carl,), 1500))
+        self.mgr.transactions.add(outlay)
+        self.mgr.transactions.add(Refund(datetime(2010, 3, 17, 12, 0, 0), self.bob, 333, carl))
+        self.mgr.transactions.add(Outlay(None, "Empty"))
+
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            writeBinaryPot(self.mgr, path)
+            pot = BinaryPot(path)
+            self.assertEqual(pot.getName(), self.mgr.name)
+            self.assertEqual(pot.computeTotals(), self.mgr.computeTotals())
+            self.assertEqual(pot.computeBalances(), self.mgr.computeBalances())
+            self.assertEqual(pot.computeDebts(), self.mgr.computeDebts())
+            self.assertEqual(pot.toDebtManager().getReport(), self.mgr.getReport())
+            try:
+                import numpy
+            except ImportError:
+                pass
+            else:
+                self.assertEqual(pot.toColumnarPot().computeBalances(), self.mgr.computeBalances())
+            pot.close()
+        finally:
+            os.remove(path)
+
+    def test_receipt_importer(self):
+        from StringIO import StringIO
+        from potcommunimport import ReceiptImporter
+        csvData = StringIO(
+            "receipt,date,outlay,type,persons,label,amount\n"
+            "1,2010-03-15 20:00,Restaurant le Grizzli,item,Alice,Starter,\"5,00 €\"\n"
+            "1,2010-03-15 20:00,Restaurant le Grizzli,item,Alice,Course,20\n"
+            "1,2010-03-15 20:00,Restaurant le Grizzli,item,Bob,Course,25\n"
+            "1,2010-03-15 20:00,Restaurant le Grizzli,item,Bob,Wine,10.00\n"
+            "1,2010-03-15 20:00,Restaurant le Grizzli,payment,Alice,,60\n"
+            "2,2010-03-15 21:00,Cinema,item,Alice;Bob,ticket,20\n"
+            "2,2010-03-15 21:00,Cinema,payment,Bob,,twenty\n"
+            "2,2010-03-15 21:00,Cinema,payment,Bob,,20\n"
+            "3,yesterday,Bad,item,Bob,x,1\n"
+            "4,2010-03-16 12:00,Lunch,eaten,Bob,x,1\n"
+        )
+        mgr = DebtManager()
+        result = ReceiptImporter(mgr, batchSize=1).importCsv(csvData)
+        self.assertEqual(result.rows, 10)
+        self.assertEqual(result.outlays, 2)
+        self.assertEqual([error.lineNumber for error in result.errors], [8, 10, 11])
+        self.assertEqual(mgr.computeDebts(), self.mgr.computeDebts())
+        self.assertEqual(mgr.getReport(), self.mgr.getReport())
+
+        jsonData = StringIO(
+            '{"receipt": "r", "date": "", "outlay": "Pizza", "type": "payment", "persons": ["Bob"], "amount": 1000}\n'
+            '\n'
+            '{"receipt": "r", "type": "persons", "persons": "Alice;Bob"}\n'
+            '{"receipt": "r", "type": "item", \n'
+        )
+        result = ReceiptImporter(mgr).importJsonLines(jsonData)
+        self.assertEqual(result.rows, 3)
+        self.assertEqual([error.lineNumber for error in result.errors], [4])
+        self.assertEqual(len(mgr.transactions), 3)
+        self.assertEqual(len(mgr.getPersons()), 2)
+        self.assertEqual(mgr.computeDebts(), ((self.bob, 2000, self.alice),))
+
+    def test_report_items_padding(self):
+        """
+            The labels are padded to the longest one plus 5, whatever the number of outlays.
+        """
+        items = {
+            (datetime(2010, 3, 15, 20, 0, 0), u"Restaurant", 2500): set(((u"Course", 2500),)),
+            (datetime(2010, 3, 15, 21, 0, 0), u"Cinema", 1000): set(((u"1/2 ticket", 1000),)),
+            (datetime(2010, 3, 16, 12, 0, 0), u"Lunch", 750): set(((u"(1/2)", 750),)),
+        }
+        expected = (u"\n --- Dépenses ---\n\n"
+            u"2010-03-15 20:00:00 - Restaurant\n"
+            u" - Course         25,00 €\n"
+            u" = Total          25,00 €\n\n"
+            u"2010-03-15 21:00:00 - Cinema\n"
+            u" - 1/2 ticket     10,00 €\n"
+            u" = Total          10,00 €\n\n"
+            u"2010-03-16 12:00:00 - Lunch\n"
+            u" - (1/2)           7,50 €\n"
+            u" = Total          7,50 €\n\n"
+            u"Total             42,50 €\n")
+        self.assertEqual(self.mgr.getReportItems(items), (4250, expected))
+
+    def test_write_report(self):
+        from StringIO import StringIO
+        self.mgr.transactions.add(Refund(datetime(2010, 3, 16, 21, 0, 0), self.bob, 500, self.alice))
+        stream = StringIO()
+        self.mgr.writeReport(stream, "utf-8")
+        self.assertEqual(stream.getvalue(), self.mgr.getReport().encode("utf-8"))
+        self.assertEqual(u"".join(self.mgr.iterReport()), self.mgr.getReport())
+        self.assertEqual(self.mgr.getReportRefunds(self.mgr.getRefundsPerPerson()[self.bob])[0], -500)
+        self.assertTrue(self.mgr.getReport().endswith(u"Bob doit 20,00 € à Alice\n\n"))
+
+    def test_parallel_report(self):
+        from multiprocessing.pool import ThreadPool
+        self.mgr.transactions.add(Refund(datetime(2010, 3, 16, 21, 0, 0), self.bob, 500, self.alice))
+        self.mgr.transactions.add(Outlay(None, "Empty"))
+        expected = self.mgr.getReport()
+        self.assertEqual(self.mgr.getParallelReport(2), expected)
+        self.assertEqual(self.mgr.getParallelReport(2, useProcesses=False), expected)
+        pool = ThreadPool(3)
+        self.assertEqual(u"".join(self.mgr.iterReport(pool)), expected)
+        pool.close()
+        from multiprocessing import Pool
+        pool = Pool(2)
+        self.assertEqual(self.mgr.getReport(pool), expected)
+        # The sections are pickled without the pot, which can't be with an observer
+        self.mgr.subscribeBalances(lambda changes: None)
+        self.assertEqual(self.mgr.getReport(pool), expected)
+        pool.close()
+        self.assertEqual(DebtManager("Empty").getParallelReport(2), DebtManager("Empty").getReport())
+
+    def test_compact_representation(self):
+        import pickle
+        self.assertTrue(Person("Alice") is self.alice)
+        self.assertTrue(Person(u"Alice") is self.alice)
+        self.assertTrue(pickle.loads(pickle.dumps(self.alice, 2)) is self.alice)
+
+        item1 = Item((self.alice, self.bob), "ticket", 1000)
+        item2 = Payment((Person("Bob"), Person("Alice")), 500)
+        self.assertTrue(item1.persons is item2.persons)
+        self.assertFalse(hasattr(item1, "__dict__"))
+        self.assertFalse(hasattr(self.alice, "__dict__"))
+        self.assertFalse(hasattr(Outlay(None, "Empty"), "__dict__"))
+        self.assertTrue(isinstance(item1.persons, frozenset))
+
+        self.mgr.transactions.add(Refund(datetime(2010, 3, 16), self.bob, 500, self.alice))
+        for protocol in (0, 2):
+            mgr = pickle.loads(pickle.dumps(self.mgr, protocol))
+            self.assertEqual(mgr.computeBalances(), self.mgr.computeBalances())
+            self.assertEqual(mgr.computePerPersonIndex(), self.mgr.computePerPersonIndex())
+            # Still told about the changes
+            cinema = [transaction for transaction in mgr.transactions if getattr(transaction, "label", None) == "Cinema"][0]
+            set(cinema.payments).pop().amount = 3000
+            self.assertEqual(mgr.computeBalances(), {self.alice: -1500, self.bob: 1500})
+            self.assertEqual(self.mgr.computeBalances(), {self.alice: -2000, self.bob: 2000})
+
+    def test_amounts_batches(self):
+        amounts, errors = getAmountsAsInt([u"12", u"12,5", u"12.50 €", u"", u"douze", u"1234567890", 300])
+        self.assertEqual(amounts, [1200, 1205, 1250, 0, 0, 0, 300])
+        self.assertEqual(errors, [False, False, False, False, True, True, False])
+        for text in (u"12", u"7,05", u" 3 €", u""):
+            self.assertEqual(getAmountAsInt(text), getAmountsAsInt([text])[0][0])
+        self.assertRaises(IndexError, getAmountAsInt, u"douze")
+        self.assertEqual(getAmountsAsString([150, 0, -150]), [getAmountAsString(a) for a in (150, 0, -150)])
+
+    def test_pot_service(self):
+        import json
+        import threading
+        import urllib2
+        from potcommunstorage import SQLiteHandler
+        from potcommunservice import PotService, PotServer
+        service = PotService(SQLiteHandler(checkSameThread=False), maxPots=1)
+        server = PotServer(service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            def request(path, data=None):
+                body = None if data is None else json.dumps(data)
+                response = urllib2.urlopen(server.getUrl() + path, body)
+                return response.read()
+
+            restaurant = {"date": "2010-03-15T20:00:00", "label": "Restaurant le Grizzli",
+                "items": [{"persons": ["Alice"], "label": "Starter", "amount": 500}, {"persons": ["Alice"], "label": "Course", "amount": 2000},
+                    {"persons": ["Bob"], "label": "Course", "amount": 2500}, {"persons": ["Bob"], "label": "Wine", "amount": 1000}],
+                "payments": [{"persons": ["Alice"], "amount": 6000}]}
+            cinema = {"date": "2010-03-15T21:00:00", "label": "Cinema",
+                "items": [{"persons": ["Alice", "Bob"], "label": "ticket", "amount": 2000}],
+                "payments": [{"persons": ["Bob"], "amount": 2000}]}
+            self.assertEqual(json.loads(request("/pots/unnamed/transactions", restaurant)), {"transactions": 1})
+            request("/pots/other/transactions", {"persons": ["Carl"], "payments": [{"persons": ["Carl"], "amount": 10}]})
+            self.assertEqual(json.loads(request("/pots/unnamed/transactions", cinema)), {"transactions": 2})
+            request("/pots/other/transactions", {"type": "refund", "debitPerson": "Carl", "creditPerson": "Dan", "amount": 10})
+
+            self.assertEqual(json.loads(request("/pots")), ["other", "unnamed"])
+            self.assertEqual(json.loads(request("/pots/unnamed/balances")), {"Alice": -2500, "Bob": 2500})
+            self.assertEqual(json.loads(request("/pots/unnamed/debts")), [["Bob", 2500, "Alice"]])
+            self.assertEqual(request("/pots/unnamed/report").decode("utf-8"), self.mgr.getReport())
+            self.assertEqual(json.loads(request("/pots/other/debts")), [["Dan", 10, "Carl"]])
+            self.assertEqual(len(service.pots), 1)
+
+            def getErrorCode(path, data=None):
+                try:
+                    request(path, data)
+                except urllib2.HTTPError, e:
+                    return e.code
+            self.assertEqual(getErrorCode("/pots/nothing/debts"), 404)
+            self.assertEqual(getErrorCode("/pots/unnamed/transactions", {"items": [{"persons": ["A"]}]}), 400)
+            self.assertEqual(getErrorCode("/pots/other/transactions", {"type": "refund", "creditPerson": "Dan", "amount": 10}), 400)
+            self.assertEqual(getErrorCode("/pots/other/transactions", {"payments": [{"persons": [], "amount": 100}]}), 400)
+            payments = [{"persons": ["Carl"], "amount": 100}]
+            for data in ({"persons": "AB", "payments": payments},
+                    {"items": [{"persons": "AB", "amount": 100}], "payments": payments},
+                    {"payments": [{"persons": "Carl", "amount": 100}]},
+                    {"items": [{"persons": ["Carl"], "amount": 100, "weights": [["Carl", 1]]}], "payments": payments}):
+                self.assertEqual(getErrorCode("/pots/other/transactions", data), 400)
+            self.assertEqual(json.loads(request("/pots/other/debts")), [["Dan", 10, "Carl"]])
+            self.assertEqual(json.loads(request("/pots")), ["other", "unnamed"])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            service.close()
+
+    def test_generate_trip(self):
+        from potcommunbench import generateTrip
+        mgr = generateTrip(personsCount=6, outlaysCount=50, itemsPerOutlay=3, refundRatio=0.5, seed=3)
+        self.assertTrue(len(mgr.transactions) > 50)
+        self.assertTrue(any(isinstance(transaction, Refund) for transaction in mgr.transactions))
+        self.assertEqual(len(mgr.getPersons()), 6)
+        self.assertEqual(sum(mgr.computeBalances().values()), 0)
+        for transaction in mgr.transactions:
+            self.assertTrue(transaction.getBalance() >= 0)
+        other = generateTrip(personsCount=6, outlaysCount=50, itemsPerOutlay=3, refundRatio=0.5, seed=3)
+        self.assertEqual(sorted(transaction.getPaymentsTotalAmount() for transaction in mgr.transactions),
+            sorted(transaction.getPaymentsTotalAmount() for transaction in other.transactions))
+
+    def test_profiling(self):
+        report = self.mgr.getReport()
+        self.mgr.transactions.add(Refund(datetime(2010, 3, 16), self.bob, 1000, self.alice))
+        self.assertEqual(self.mgr.getProfilingStats(), {})
+
+        profiledReport, stats = self.mgr.profileReport()
+        self.assertNotEqual(profiledReport, report)
+        self.assertEqual(profiledReport, self.mgr.getReport())
+        # The refund for the ledger, the two outlays for the index
+        self.assertEqual(stats["computeTransactionTotals"]["calls"], 3)
+        # Only the refund totals were not memoized
+        self.assertEqual(stats["checkAndAdjustTotals"]["calls"], 1)
+        self.assertEqual(stats["getPaymentsOrItemsOrRefundsPerPerson"]["calls"], 3)
+        self.assertTrue(stats["getPaymentsOrItemsOrRefundsPerPerson"]["time"] >= stats["computePerPersonIndex"]["time"])
+        self.assertEqual(stats["computeDebts"]["calls"], 1)
+        self.assertEqual(stats["computeDebts"]["objects"], len(self.mgr.computeDebts()))
+        self.assertEqual(stats["iterPersonReport"]["calls"], 2)
+        self.assertTrue(stats["iterPersonReport"]["objects"] > 0)
+        self.assertTrue(stats["computeBalances"]["time"] >= stats["updateLedger"]["time"])
+        self.assertTrue("profiler" not in self.mgr.__dict__)
+        self.assertTrue("computeTotals" not in self.mgr.__dict__)
+
+        profiler = self.mgr.enableProfiling()
+        self.mgr.computeDebts()
+        self.mgr.computeDebts()
+        self.assertEqual(self.mgr.getProfilingStats()["settleBalances"]["calls"], 2)
+        self.assertTrue(self.mgr.disableProfiling() is profiler)
+        self.assertEqual(self.mgr.getProfilingStats(), {})
+
+    def test_pots_aggregator(self):
+        import os
+        import tempfile
+        from potcommunbinary import writeBinaryPot, BinaryPot
+        from potcommunstorage import SQLiteHandler
+        from potcommunaggregate import PotsAggregator, StoredPot
+        carl = Person(u"Carl")
+        second = DebtManager(u"Second")
+        outlay = Outlay(datetime(2010, 4, 1), u"Hotel")
+        outlay.items.add(Item((self.alice, carl), u"Room", 9000))
+        outlay.payments.add(Payment((carl,), 9000))
+        second.transactions.add(outlay)
+        third = DebtManager(u"Third")
+        third.transactions.add(Refund(datetime(2010, 4, 2), self.bob, 1500, self.alice))
+
+        directory = tempfile.mkdtemp()
+        try:
+            writeBinaryPot(second, os.path.join(directory, "second.pot"))
+            handler = SQLiteHandler(os.path.join(directory, "pots.sqlite"))
+            handler.save(third)
+            handler.close()
+
+            expected = {self.alice: -2500 + 4500 + 1500, self.bob: 2500 - 1500, carl: -4500}
+            aggregator = PotsAggregator([self.mgr, StoredPot(BinaryPot, (os.path.join(directory, "second.pot"),)),
+                StoredPot(SQLiteHandler, (os.path.join(directory, "pots.sqlite"),), u"Third")], workers=2)
+            self.assertEqual(aggregator.computeBalancesPerPot()[0], self.mgr.computeBalances())
+            self.assertEqual(aggregator.computeBalances(), expected)
+            self.assertEqual(aggregator.computeDebts(), DebtManager.settleBalances(expected))
+            self.assertEqual(len(aggregator.computeMinimalDebts()), 2)
+            aggregator.useProcesses = False
+            self.assertEqual(aggregator.computeBalances(), expected)
+            self.assertEqual(PotsAggregator().computeDebts(), ())
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_balances_as_of(self):
+        from datetime import timedelta
+        from potcommunbench import generateTrip
+        mgr = generateTrip(personsCount=6, outlaysCount=300, itemsPerOutlay=3, refundRatio=0.3, seed=5)
+        undated = Outlay(None, u"Undated")
+        undated.items.add(Item((Person(u"Person 0"),), u"Gift", 700))
+        undated.payments.add(Payment((Person(u"Person 1"),), 700))
+        mgr.transactions.add(undated)
+
+        def getExpectedBalances(asOf):
+            expected = DebtManager()
+            expected.transactions.update(transaction for transaction in mgr.transactions
+                if transaction.date is None or transaction.date <= asOf)
+            return expected.computeBalances()
+
+        start = datetime(2010, 1, 1)
+        for hours in (-1, 0, 63, 64, 100, 128, 299, 400):
+            asOf = start + timedelta(hours=hours, minutes=30)
+            self.assertEqual(mgr.computeBalances(asOf=asOf), getExpectedBalances(asOf))
+        self.assertEqual(mgr.computeDebts(asOf=start + timedelta(days=30)), mgr.computeDebts())
+
+        between = mgr.getTransactionsBetween(start + timedelta(hours=10), start + timedelta(hours=20))
+        self.assertEqual(set(transaction.label for transaction in between if isinstance(transaction, Outlay)),
+            set(u"Outlay %d" % hour for hour in range(10, 20)))
+        self.assertEqual(sorted(between, key=lambda transaction: transaction.date), between)
+        self.assertTrue(undated in mgr.getTransactionsBetween(stop=start))
+        self.assertEqual(len(mgr.getTransactionsBetween()), len(mgr.transactions))
+
+        # The index follows the changes
+        asOf = start + timedelta(hours=5)
+        before = mgr.computeBalances(asOf=asOf)
+        undated.payments.add(Payment((Person(u"Person 2"),), 300))
+        self.assertNotEqual(mgr.computeBalances(asOf=asOf), before)
+        self.assertEqual(mgr.computeBalances(asOf=asOf), getExpectedBalances(asOf))
+
+    def test_apportion(self):
+        self.assertEqual(apportion(10, [("a", 1), ("b", 1), ("c", 1)]), {"a": 4, "b": 3, "c": 3})
+        self.assertEqual(apportion(-10, [("a", 1), ("b", 1), ("c", 1)]), {"a": -3, "b": -3, "c": -4})
+        self.assertEqual(apportion(1000, [("adult", 2), ("child", 1), ("other", 2)]), {"adult": 400, "child": 200, "other": 400})
+        self.assertEqual(apportion(1001, [("a", 2), ("b", 1), ("c", 0)]), {"a": 667, "b": 334, "c": 0})
+        self.assertEqual(apportion(7, [("a", 3), ("b", 3), ("c", 1)]), {"a": 3, "b": 3, "c": 1})
+        self.assertEqual(apportion(8, [("c", 3), ("b", 3), ("a", 1)]), {"a": 1, "b": 3, "c": 4})
+        self.assertRaises(ZeroDivisionError, apportion, 10, [("a", 0)])
+
+        # The cents left go to the first persons by name, whatever the set order
+        carl = Person(u"Carl")
+        item = Item((carl, self.bob, self.alice), "Pizza", 1001)
+        self.assertEqual(item.computeAmountPerPerson(), {self.alice: 334, self.bob: 334, carl: 333})
+        item = Item((carl, self.alice), "Wine", 1001, {self.alice: 2, carl: 1})
+        self.assertEqual(item.computeAmountPerPerson(), {self.alice: 667, carl: 334})
+        self.assertNotEqual(item, Item((carl, self.alice), "Wine", 1001))
+        self.assertRaises(ValueError, Item, (carl, self.alice), "Wine", 1001, {self.alice: 2})
+        self.assertRaises(ValueError, Item, (carl,), "Wine", 1001, {carl: 0})
+
+        outlay = Outlay(datetime(2010, 3, 16), u"Dîner")
+        outlay.items.add(item)
+        outlay.payments.add(Payment((self.bob,), 1002))
+        outlay.addPersons((self.bob,))
+        self.mgr.transactions.add(outlay)
+        self.assertEqual(outlay.getTotals()[0], {self.alice: 668, self.bob: 0, carl: 334})
+        self.assertTrue(u"2/3 Wine" in self.mgr.getReport())
+
+        from potcommunstorage import SQLiteHandler
+        handler = SQLiteHandler()
+        handler.save(self.mgr)
+        mgr = handler.load(self.mgr.name)
+        self.assertTrue(item in [element for transaction in mgr.transactions for element in transaction.items])
+        self.assertEqual(mgr.computeBalances(), self.mgr.computeBalances())
+        handler.close()
+
+    def test_edit_session(self):
+        class Listener(object):
+            def __init__(self):
+                self.changes = []
+            def transactionChanged(self, transaction):
+                self.changes.append(transaction)
+        listener = Listener()
+        self.mgr.listeners.add(listener)
+        balances = self.mgr.computeBalances()
+        restaurant, cinema = sorted(self.mgr.transactions, key=lambda transaction: transaction.date)
+
+        with self.mgr.edit() as session:
+            restaurant.items.add(Item((self.bob,), "Dessert", 700))
+            restaurant.payments.add(Payment((self.bob,), 700))
+            self.mgr.transactions.add(Refund(datetime(2010, 3, 16), self.bob, 2500, self.alice))
+            self.assertEqual(listener.changes, [])
+            # Only the changed transactions are saved, before their first change
+            self.assertEqual(session.states.keys(), [restaurant])
+        self.assertEqual(len(listener.changes), 2)
+        self.assertEqual(self.mgr.computeBalances(), {self.alice: 0, self.bob: 0})
+
+        # A wrong transaction rolls back the whole session
+        del listener.changes[:]
+        balances = self.mgr.computeBalances()
+        # Compared by content: the report depends on the iteration order of the rebuilt sets
+        index = self.mgr.computePerPersonIndex()
+        def editBadly():
+            with self.mgr.edit():
+                self.mgr.transactions.remove(cinema)
+                cinema.label = "Cine"
+                restaurant.label = "Grizzli"
+                restaurant.items.clear()
+                restaurant.payments.add(Payment((), 100))
+        self.assertRaises(ValueError, editBadly)
+        self.assertEqual(listener.changes, [])
+        self.assertTrue(cinema in self.mgr.transactions)
+        self.assertEqual((cinema.label, restaurant.label), ("Cinema", "Restaurant le Grizzli"))
+        self.assertEqual(self.mgr.computeBalances(), balances)
+        self.assertEqual(self.mgr.getPerPersonIndex(), index)
+
+        # So does an exception
+        ticket = set(cinema.items).pop()
+        def fail():
+            with self.mgr.edit():
+                cinema.items.add(Item((self.alice,), "Popcorn", 500))
+                ticket.amount = 9000
+                cinema.date = datetime(2011, 1, 1)
+                raise KeyError("popcorn")
+        self.assertRaises(KeyError, fail)
+        self.assertEqual((ticket.amount, cinema.date), (2000, datetime(2010, 3, 15, 21, 0, 0)))
+        self.assertEqual(self.mgr.computeBalances(), balances)
+
+        # Even when all the transactions are replaced
+        transactions = set(self.mgr.transactions)
+        def replaceAll():
+            with self.mgr.edit():
+                self.mgr.transactions = set()
+                raise KeyError("all")
+        self.assertRaises(KeyError, replaceAll)
+        self.assertEqual(set(self.mgr.transactions), transactions)
+        self.assertEqual(self.mgr.computeBalances(), balances)
+        self.assertTrue(self.mgr.session is None)
+
+    def test_balance_observers(self):
+        notifications = []
+        self.mgr.subscribeBalances(notifications.append)
+        carl = Person(u"Carl")
+        restaurant, cinema = sorted(self.mgr.transactions, key=lambda transaction: transaction.date)
+
+        def check(change, count=1):
+            """
+                Check that change() is told in count notifications, with the changed balances only.
+            """
+            del notifications[:]
+            before = self.mgr.computeBalances()
+            change()
+            after = self.mgr.computeBalances()
+            self.assertEqual(len(notifications), count)
+            told = {}
+            for changes in notifications:
+                told.update(changes)
+            persons = set(before) | set(after)
+            self.assertEqual(told, dict((person, after.get(person, 0)) for person in persons
+                if before.get(person, 0) != after.get(person, 0)))
+
+        check(lambda: cinema.payments.add(Payment((self.alice,), 500)))
+        self.assertEqual(notifications, [{self.alice: -2750, self.bob: 2750}])
+
+        refund = Refund(datetime(2010, 3, 16), self.bob, 2750, self.alice)
+        lunch = Outlay(datetime(2010, 3, 17), "Lunch")
+        lunch.items.add(Item((carl,), "Salad", 300))
+        lunch.payments.add(Payment((carl,), 300))
+        check(lambda: self.mgr.transactions.update([refund, lunch]))
+        self.assertEqual(notifications, [{self.alice: 0, self.bob: 0}])
+
+        # Told once, after the whole update
+        check(lambda: refund.update(refund.date, self.bob, 1000, self.alice))
+        self.assertEqual(notifications, [{self.alice: -1750, self.bob: 1750}])
+        check(lambda: refund.update(refund.date, self.bob, 2750, self.alice))
+
+        def edit():
+            with self.mgr.edit():
+                lunch.payments.clear()
+                lunch.payments.add(Payment((self.alice,), 300))
+                restaurant.items.add(Item((self.alice, carl), "Wine", 1000))
+                self.assertEqual(notifications, [])
+        check(edit)
+        self.assertEqual(set(notifications[0]), set([self.alice, self.bob, carl]))
+
+        check(lambda: self.mgr.transactions.remove(lunch))
+        check(lambda: self.mgr.transactions.remove(restaurant))
+        self.assertEqual(notifications[0][carl], 0)
+
+        del notifications[:]
+        self.mgr.unsubscribeBalances(notifications.append)
+        self.mgr.transactions.add(restaurant)
+        self.assertEqual(notifications, [])
+        self.assertRaises(ValueError, DebtManager(incremental=False).subscribeBalances, notifications.append)
+
+    def test_pairwise_ledger(self):
+        from potcommunpairs import PairwiseLedger
+        ledger = PairwiseLedger(self.mgr)
+        self.assertEqual(ledger.getOwed(self.bob, self.alice), 3500 - 1000)
+        self.assertEqual(ledger.getOwed(self.alice, self.bob), -2500)
+
+        carl = Person(u"Carl")
+        outlay = Outlay(datetime(2010, 3, 17), "Hotel")
+        outlay.items.add(Item((self.alice, self.bob, carl), "Room", 9000))
+        outlay.payments.add(Payment((carl,), 6000))
+        outlay.payments.add(Payment((self.bob,), 3000))
+        self.mgr.transactions.add(outlay)
+        self.mgr.transactions.add(Refund(datetime(2010, 3, 18), self.alice, 500, carl))
+        # Alice's room: 2000 fronted by Carl, 1000 by Bob; Bob's: 2000 by Carl; Carl's: 1000 by Bob
+        self.assertEqual(ledger.getOwed(self.alice, carl), 2000 - 500)
+        self.assertEqual(ledger.getOwed(self.bob, carl), 2000 - 1000)
+        self.assertEqual(ledger.getOwed(self.bob, self.alice), 2500 - 1000)
+        self.assertEqual(ledger.getCounterparties(carl), {self.alice: -1500, self.bob: -1000})
+        self.assertEqual(ledger.getTopCounterparties(carl, 1), [(self.alice, -1500)])
+
+        balances = self.mgr.computeBalances()
+        for person in self.mgr.getPersons():
+            self.assertEqual(sum(ledger.getCounterparties(person).values()), balances[person])
+
+        self.mgr.transactions.remove(outlay)
+        self.assertEqual(ledger.getOwed(self.bob, carl), 0)
+        self.assertEqual(ledger.getCounterparties(carl), {self.alice: 500})
+
+        # Amounts which can't be split evenly: the pairs still sum up to the balances
+        mgr = DebtManager()
+        ledger = PairwiseLedger(mgr)
+        x, y = Person(u"X"), Person(u"Y")
+        outlay = Outlay(datetime(2010, 3, 19), "Sweets")
+        for person in (self.alice, self.bob, carl):
+            outlay.items.add(Item((person,), "Sweet", 1))
+        outlay.payments.add(Payment((x,), 1))
+        outlay.payments.add(Payment((y,), 2))
+        mgr.transactions.add(outlay)
+        self.assertEqual(ledger.getCounterparties(x), {self.alice: -1})
+        self.assertEqual(ledger.getCounterparties(y), {self.bob: -1, carl: -1})
+        outlay.items.add(Item((self.alice, self.bob, carl, x), "Cake", 1001))
+        outlay.payments.add(Payment((self.alice,), 500))
+        outlay.payments.add(Payment((carl,), 503))
+        balances = mgr.computeBalances()
+        for person in mgr.getPersons():
+            self.assertEqual(sum(ledger.getCounterparties(person).values()), balances[person])
+        ledger.close()
+        self.assertFalse(ledger in self.mgr.listeners)
+
+    def test_persons_registry(self):
+        registry = self.mgr.personsRegistry
+        self.mgr.computeTotals()
+        self.assertEqual(sorted(registry.getId(person) for person in (self.alice, self.bob)), [0, 1])
+        self.assertTrue(registry.getPerson(registry.getId(self.bob)) is self.bob)
+
+        carl = Person(u"Carl")
+        lunch = Outlay(datetime(2010, 3, 17), "Lunch")
+        lunch.items.add(Item((carl, self.alice), "Salad", 300))
+        lunch.payments.add(Payment((carl,), 300))
+        self.mgr.transactions.add(lunch)
+        self.assertEqual(self.mgr.computeBalances(), {self.alice: -2350, self.bob: 2500, carl: -150})
+        self.assertEqual(registry.getId(carl), 2)
+
+        self.mgr.transactions.remove(lunch)
+        self.assertEqual(self.mgr.computeTotals(), self.mgr.computeTotalsFromScratch())
+        self.assertEqual(self.mgr.computeBalances(), {self.alice: -2500, self.bob: 2500})
+        self.assertEqual(len(registry), 3)
+
+    def test_batch_settlement(self):
+        import os
+        import json
+        import shutil
+        import tempfile
+        from potcommunbinary import writeBinaryPot
+        from potcommunstorage import SQLiteHandler, JournalHandler
+        from potcommunbatch import settlePots
+        directory = tempfile.mkdtemp()
+        try:
+            pots = os.path.join(directory, "pots")
+            os.makedirs(pots)
+            writeBinaryPot(self.mgr, os.path.join(pots, "trip.pot"))
+            report = self.mgr.getReport()
+            handler = SQLiteHandler(os.path.join(pots, "pots.sqlite"))
+            self.mgr.name = u"Montagne"
+            handler.save(self.mgr)
+            other = DebtManager(u"Mer")
+            other.transactions.add(Refund(datetime(2010, 3, 16), self.bob, 500, self.alice))
+            handler.save(other)
+            handler.close()
+            JournalHandler(os.path.join(pots, "journal")).save(self.mgr)
+            with open(os.path.join(pots, "notes.txt"), "w") as notes:
+                notes.write("Not a pot\n")
+            with open(os.path.join(directory, "manifest.txt"), "w") as manifest:
+                manifest.write("# Only one pot\npots/pots.sqlite:Mer\npots/missing.pot\n")
+
+            output = os.path.join(directory, "output")
+            summary = settlePots([pots], output, workers=2)
+            self.assertEqual(summary["errors"], 0)
+            self.assertEqual([(pot["kind"], pot["name"]) for pot in summary["pots"]],
+                [("journal", None), ("sqlite", u"Mer"), ("sqlite", u"Montagne"), ("binary", None)])
+            expected = [[debtor.name, amount, creditor.name] for debtor, amount, creditor in self.mgr.computeDebts()]
+            for pot in summary["pots"]:
+                with open(pot["output"]) as outputFile:
+                    self.assertEqual(json.load(outputFile), expected if pot["name"] != u"Mer" else [[u"Alice", 500, u"Bob"]])
+            with open(os.path.join(output, "summary.json")) as summaryFile:
+                self.assertEqual(len(json.load(summaryFile)["pots"]), 4)
+
+            summary = settlePots([os.path.join(directory, "manifest.txt"), os.path.join(pots, "trip.pot")], output, report=True, workers=1)
+            self.assertEqual([pot["kind"] for pot in summary["pots"]], ["sqlite", "missing", "binary"])
+            self.assertEqual(summary["errors"], 1)
+            self.assertTrue("missing.pot" in summary["pots"][1]["error"])
+            with open(summary["pots"][2]["output"]) as outputFile:
+                self.assertEqual(outputFile.read().decode("utf-8"), report)
+
+            # Pots with the same file name, and a database without pots table
+            import sqlite3
+            more = os.path.join(directory, "more")
+            for name in ("a", "b"):
+                os.makedirs(os.path.join(more, name))
+            writeBinaryPot(self.mgr, os.path.join(more, "a", "trip.pot"))
+            writeBinaryPot(other, os.path.join(more, "b", "trip.pot"))
+            connection = sqlite3.connect(os.path.join(more, "broken.sqlite"))
+            connection.execute("CREATE TABLE other (id INTEGER)")
+            connection.close()
+            summary = settlePots([more, os.path.join(more, "a", "trip.pot")], output, workers=2)
+            self.assertEqual([os.path.basename(pot["output"] or "") for pot in summary["pots"]],
+                ["more_a_trip.pot.json", "more_b_trip.pot.json", "", "trip.pot.json"])
+            self.assertEqual(summary["errors"], 1)
+            self.assertTrue("no such table" in summary["pots"][2]["error"])
+            with open(summary["pots"][1]["output"]) as outputFile:
+                self.assertEqual(json.load(outputFile), [[u"Alice", 500, u"Bob"]])
+        finally:
+            shutil.rmtree(directory)